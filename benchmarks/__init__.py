@@ -0,0 +1,5 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
@@ -0,0 +1,88 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+"""
+Benchmarks apply and freeze on generated projects, offline. Run it from the repository root:
+
+    PYTHONPATH=src python -m benchmarks --targets 8 --output before.json
+"""
+
+import sys
+import json
+import platform
+import argparse
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import environ
+from .fixtures import make_project, git
+from .runner import run_all
+
+# Submodules of the generated upstreams are cloned through file:// URLs
+GIT_CONFIG = {
+    'GIT_CONFIG_COUNT': '1',
+    'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+    'GIT_CONFIG_VALUE_0': 'always',
+}
+
+
+def parse_cli():
+    p = argparse.ArgumentParser(prog='python -m benchmarks',
+                                description='Benchmark Castor on generated local projects')
+
+    p.add_argument('--targets', type=int, default=4, help='Number of Git targets')
+    p.add_argument('--files', type=int, default=200, help='Number of files per target')
+    p.add_argument('--history', type=int, default=20, help='Number of commits per target')
+    p.add_argument('--tags', type=int, default=10, help='Number of tags per target')
+    p.add_argument('--submodules', type=int, default=0, help='Number of submodules per target')
+    p.add_argument('--nesting', type=int, default=1, help='How deep targets are nested')
+    p.add_argument('-j', '--jobs', type=int, default=1, help='Jobs passed to apply and freeze')
+    p.add_argument('--repeat', type=int, default=1, help='Number of runs of each scenario')
+    p.add_argument('--only', action='append', default=[], help='Only run this scenario')
+    p.add_argument('--workdir', type=str, default=None, help='Where to generate the project '
+                                                             '(kept after the run)')
+    p.add_argument('-o', '--output', type=str, default=None, help='JSON report (defaults to '
+                                                                  'stdout)')
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_cli()
+    environ.update(GIT_CONFIG)
+
+    params = {k: getattr(args, k) for k in ('targets', 'files', 'history', 'tags', 'submodules',
+                                            'nesting', 'jobs', 'repeat')}
+    workdir = args.workdir or mkdtemp(prefix='castor-bench-')
+
+    try:
+        root = make_project(workdir, args.targets, args.files, args.history, args.tags,
+                            args.submodules, max(args.nesting, 1))
+        results = run_all(root, {'jobs': args.jobs, 'repeat': args.repeat, 'only': args.only})
+    finally:
+        if args.workdir is None:
+            rmtree(workdir)
+
+    report = {
+        'params': params,
+        'environment': {
+            'python': platform.python_version(),
+            'git': git('.', '--version').decode().strip(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
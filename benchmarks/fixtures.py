@@ -0,0 +1,203 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import json
+import subprocess
+
+from os import path, makedirs, environ
+from castor.repo import init
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Castor Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@castor.invalid',
+    'GIT_COMMITTER_NAME': 'Castor Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@castor.invalid',
+}
+
+# Fixed dates make the generated repos (and thus their SHAs) reproducible
+EPOCH = 1420070400
+
+
+def git(cwd, *args, data=None):
+    """
+    Runs a git command and returns its output
+    """
+
+    command = ['git'] + list(args)
+    proc = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            env=dict(environ, **GIT_ENV))
+    out, _ = proc.communicate(data)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, out)
+
+    return out
+
+
+def blob(content):
+    content = content.encode('utf-8')
+    return b'data ' + str(len(content)).encode() + b'\n' + content + b'\n'
+
+
+def file_content(name, revision):
+    return '{} revision {}\n{}'.format(name, revision, 'x' * 64 + '\n') * 8
+
+
+def make_upstream(repo_path, files, history, tags, submodules=()):
+    """
+    Creates a bare repo with `history` commits, using a single fast-import stream. The first
+    commit adds `files` files, spread into directories, and each following commit modifies one
+    of them. `tags` tags are spread along the history, the last commit always being tagged
+    "v<history>".
+
+    `submodules` is a list of (path, url, commit) tuples which are added as gitlinks to every
+    commit.
+
+    Returns the SHA of the last commit.
+    """
+
+    makedirs(repo_path, exist_ok=True)
+    git(repo_path, 'init', '-q', '--bare')
+
+    names = ['d{}/f{}.txt'.format(i % 16, i) for i in range(files)]
+    tagged = {}
+
+    for i in range(tags):
+        commit = history - (i * history) // max(tags, 1)
+        tagged.setdefault(commit, []).append('v{}'.format(commit) if i == 0 else 't{}'.format(i))
+
+    stream = []
+
+    for revision in range(1, history + 1):
+        date = '{} +0000'.format(EPOCH + revision * 60)
+        stream.append('commit refs/heads/master\nmark :{}\n'.format(revision).encode())
+        stream.append('committer {} <{}> {}\n'.format(GIT_ENV['GIT_COMMITTER_NAME'],
+                                                      GIT_ENV['GIT_COMMITTER_EMAIL'],
+                                                      date).encode())
+        stream.append(blob('Revision {}'.format(revision)))
+
+        if revision > 1:
+            stream.append('from :{}\n'.format(revision - 1).encode())
+            changed = [names[(revision - 2) % len(names)]] if names else []
+        else:
+            changed = names
+
+            if submodules:
+                stream.append(b'M 100644 inline .gitmodules\n')
+                stream.append(blob(''.join(
+                    '[submodule "{0}"]\n\tpath = {0}\n\turl = {1}\n'.format(p, u)
+                    for p, u, _ in submodules
+                )))
+
+                for sub_path, _, sha in submodules:
+                    stream.append('M 160000 {} {}\n'.format(sha, sub_path).encode())
+
+        for name in changed:
+            stream.append('M 100644 inline {}\n'.format(name).encode())
+            stream.append(blob(file_content(name, revision)))
+
+        stream.append(b'\n')
+
+        for tag in tagged.get(revision, []):
+            stream.append('reset refs/tags/{}\nfrom :{}\n\n'.format(tag, revision).encode())
+
+    git(repo_path, 'fast-import', '--quiet', data=b''.join(stream))
+
+    return git(repo_path, 'rev-parse', 'refs/heads/master').decode().strip()
+
+
+def target_paths(count, nesting):
+    """
+    Returns the paths of `count` Git targets: the first one is the root and the others are
+    chained into each other up to `nesting` levels deep.
+    """
+
+    paths = ['/']
+
+    for i in range(1, count):
+        parent = paths[i - 1].rstrip('/') if (i - 1) % nesting else ''
+        paths.append('{}/modules/m{}'.format(parent, i))
+
+    return paths
+
+
+def make_project(workdir, targets=4, files=200, history=20, tags=10, submodules=0, nesting=1):
+    """
+    Generates upstreams and a Castor project using them in workdir. Each Git target gets its own
+    upstream with `submodules` submodules, and there is one file target per Git target.
+
+    Returns the root of the Castor project.
+    """
+
+    upstreams = path.join(workdir, 'upstreams')
+    root = path.join(workdir, 'project')
+    lodge = []
+
+    for i, target in enumerate(target_paths(targets, nesting)):
+        subs = []
+
+        for j in range(submodules):
+            sub_path = path.join(upstreams, 'u{}-s{}.git'.format(i, j))
+            sha = make_upstream(sub_path, max(files // 10, 1), 1, 1)
+            subs.append(('vendor/s{}'.format(j), 'file://' + sub_path, sha))
+
+        repo_path = path.join(upstreams, 'u{}.git'.format(i))
+        make_upstream(repo_path, files, history, tags, subs)
+
+        lodge.append({
+            'target': target,
+            'type': 'git',
+            'repo': 'file://' + repo_path,
+            'version': 'v{}'.format(history),
+        })
+
+    init(root)
+
+    for i, target in enumerate(target_paths(targets, nesting)):
+        source = 'files/f{}.txt'.format(i)
+        makedirs(path.join(root, 'files'), exist_ok=True)
+
+        with open(path.join(root, source), 'w') as f:
+            f.write(file_content(source, 0))
+
+        lodge.append({
+            'target': '{}/config{}.txt'.format(target.rstrip('/'), i),
+            'type': 'file',
+            'source': source,
+        })
+
+    with open(path.join(root, 'Castorfile'), 'w') as f:
+        json.dump({'lodge': lodge}, f, indent=4)
+
+    git(root, 'add', '--all')
+    git(root, 'commit', '-q', '-m', 'Benchmark project')
+
+    return root
+
+
+def commit_change(repo_path, revision):
+    """
+    Commits a change to one file of a lodge, as a developer would before freezing
+    """
+
+    names = sorted(git(repo_path, 'ls-files', '-z').decode().split('\0'))
+    name = [x for x in names if x.endswith('.txt')][0]
+
+    with open(path.join(repo_path, name), 'w') as f:
+        f.write(file_content(name, revision))
+
+    git(repo_path, 'commit', '-q', '-a', '-m', 'Change {}'.format(revision))
+
+
+def checkout_tag(repo_path):
+    """
+    Checks out the oldest tag of a lodge which is not on HEAD (or the commit before HEAD if there
+    is none), as a developer would to pin an older release before freezing
+    """
+
+    tags = git(repo_path, 'tag', '--list', '--sort=creatordate', '--no-points-at',
+               'HEAD').decode().split()
+    git(repo_path, 'checkout', '-q', '--detach', tags[0] if tags else 'HEAD~1')
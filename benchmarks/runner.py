@@ -0,0 +1,179 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import sys
+import time
+import resource
+import subprocess
+import multiprocessing
+
+from shutil import rmtree
+from os import path, unlink
+from castor.repo import Castor
+from .fixtures import commit_change, checkout_tag
+
+
+def git_command(args):
+    """
+    Name of the git command run by args (eg "for-each-ref"), skipping the global options
+    """
+
+    args = iter(args[1:])
+
+    for arg in args:
+        if arg in ('-c', '-C'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+
+
+def count_subprocesses():
+    """
+    Counts the processes started through subprocess.Popen (which both GitPython and Castor use)
+    from now on. Returns the dictionary of counts per executable and the dictionary of counts per
+    git command, both updated in place.
+    """
+
+    counts = {}
+    commands = {}
+    original = subprocess.Popen.__init__
+
+    def counting_init(self, args, *a, **kw):
+        if isinstance(args, (list, tuple)):
+            words = [str(x) for x in args]
+        else:
+            words = str(args).split(' ')
+
+        name = path.basename(words[0])
+        counts[name] = counts.get(name, 0) + 1
+
+        if name == 'git':
+            command = git_command(words)
+            commands[command] = commands.get(command, 0) + 1
+
+        original(self, args, *a, **kw)
+
+    subprocess.Popen.__init__ = counting_init
+
+    return counts, commands
+
+
+def measure(scenario, root, options):
+    """
+    Runs a scenario in the current process and returns its metrics. This is meant to be called in
+    a fresh process, so that the peak RSS only accounts for that scenario.
+    """
+
+    counts, commands = count_subprocesses()
+    start = time.perf_counter()
+
+    c = Castor(root)
+
+    if scenario.startswith('apply'):
+        c.apply(jobs=options['jobs'])
+    elif scenario.startswith('freeze'):
+        c.freeze(jobs=options['jobs'])
+    elif scenario == 'update_versions':
+        c.update_versions()
+
+    wall = time.perf_counter() - start
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'wall': round(wall, 4),
+        'cpu_user': round(own.ru_utime + children.ru_utime, 4),
+        'cpu_system': round(own.ru_stime + children.ru_stime, 4),
+        'peak_rss_kb': own.ru_maxrss,
+        'peak_child_rss_kb': children.ru_maxrss,
+        'subprocesses': sum(counts.values()),
+        'subprocesses_by_name': counts,
+        'git_commands': commands,
+    }
+
+
+def run_scenario(scenario, root, options):
+    ctx = multiprocessing.get_context('spawn')
+
+    with ctx.Pool(1) as pool:
+        return pool.apply(measure, (scenario, root, options))
+
+
+def lodge_paths(root):
+    return [Castor(root).target_lodge_path(x) for x in Castor(root).git_targets]
+
+
+def run_all(root, options):
+    """
+    Runs all the scenarios in order, each one starting from the state left by the previous one.
+    Returns the list of their results.
+    """
+
+    lodges = lodge_paths(root)
+    revision = [0]
+
+    def change(repos):
+        def prepare():
+            revision[0] += 1
+
+            for repo_path in repos:
+                commit_change(repo_path, 1000 + revision[0])
+
+        return prepare
+
+    def stale_versions():
+        # Moves the lodges away from the versions recorded by the previous freeze, so that
+        # update_versions has to look the tags up
+        for repo_path in lodges:
+            checkout_tag(repo_path)
+
+    def fresh_dam():
+        # Removes what a previous freeze left, so that the dam is built from scratch
+        rmtree(path.join(root, 'dam'), ignore_errors=True)
+        rmtree(path.join(root, '.castor', 'post_freeze'), ignore_errors=True)
+
+        if path.exists(path.join(root, '.castor', 'dam.json')):
+            unlink(path.join(root, '.castor', 'dam.json'))
+
+    def cold():
+        rmtree(path.join(root, 'lodge'), ignore_errors=True)
+        rmtree(path.join(root, 'dam'), ignore_errors=True)
+        rmtree(path.join(root, '.castor'), ignore_errors=True)
+
+    scenarios = [
+        ('apply_cold', cold),
+        ('apply_warm', None),
+        ('freeze_first', fresh_dam),
+        ('freeze_no_change', None),
+        ('freeze_one_change', change(lodges[-1:])),
+        ('freeze_all_change', change(lodges)),
+        ('update_versions', stale_versions),
+    ]
+
+    results = []
+
+    for name, prepare in scenarios:
+        if options['only'] and name not in options['only']:
+            continue
+
+        for i in range(options['repeat']):
+            # Each run starts from the state of its scenario
+            if prepare is not None:
+                prepare()
+
+            result = run_scenario(name, root, options)
+            result.update({'scenario': name, 'run': i})
+            results.append(result)
+
+            if name == 'update_versions' and not result['git_commands'].get('for-each-ref'):
+                raise RuntimeError('update_versions did not index the refs of any lodge, the '
+                                   'scenario does not measure the version resolution')
+
+            sys.stderr.write('{:<20} {:>8.3f}s {:>6} processes {:>8} KB\n'.format(
+                name, result['wall'], result['subprocesses'], result['peak_rss_kb']
+            ))
+
+    return results
@@ -0,0 +1,247 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import gzip
+import stat
+import tarfile
+import subprocess
+
+from contextlib import contextmanager
+from os import path, environ, lstat, readlink, replace, unlink
+from .plumbing import MODE_SYMLINK, MODE_EXECUTABLE, MODE_FILE, FILE_PERMISSIONS
+
+DIR_PERMISSIONS = 0o775
+
+FORMAT_TAR = 'tar'
+FORMAT_GZIP = 'gzip'
+FORMAT_ZSTD = 'zstd'
+
+MEMBER_DIR = 'dir'
+MEMBER_BLOB = 'blob'
+MEMBER_DISK = 'disk'
+
+
+class ArtifactException(Exception):
+    """
+    Emitted when the artifact could not be written
+    """
+    pass
+
+
+class BlobReader(object):
+    """
+    Streams blobs out of a repo through a single "git cat-file --batch" process
+    """
+
+    def __init__(self, repo):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repo.working_dir,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def open(self, sha):
+        """
+        Requests a blob and returns its size. Its content must then be read from `stream`,
+        followed by a call to done().
+        """
+
+        self.proc.stdin.write(sha.encode() + b'\n')
+        self.proc.stdin.flush()
+
+        header = self.proc.stdout.readline().decode().split()
+
+        if len(header) != 3 or header[1] != 'blob':
+            raise ArtifactException('Could not read blob {}'.format(sha))
+
+        return int(header[2])
+
+    def read(self, sha):
+        """
+        Returns the whole content of a blob
+        """
+
+        data = self.stream.read(self.open(sha))
+        self.done()
+        return data
+
+    @property
+    def stream(self):
+        return self.proc.stdout
+
+    def done(self):
+        self.proc.stdout.read(1)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.wait()
+
+
+def source_date():
+    """
+    Modification time given to all members, so that identical inputs produce identical artifacts.
+    Can be set through SOURCE_DATE_EPOCH.
+    """
+
+    try:
+        return int(environ.get('SOURCE_DATE_EPOCH', 0))
+    except ValueError:
+        return 0
+
+
+def artifact_format(out_path):
+    """
+    Guesses the format of an artifact from its extension
+    """
+
+    if out_path.endswith('.tar.zst') or out_path.endswith('.tzst'):
+        return FORMAT_ZSTD
+    elif out_path.endswith('.tar.gz') or out_path.endswith('.tgz'):
+        return FORMAT_GZIP
+    elif out_path.endswith('.tar'):
+        return FORMAT_TAR
+
+    raise ArtifactException('Unknown artifact format for "{}", use .tar, .tar.gz or '
+                            '.tar.zst'.format(out_path))
+
+
+@contextmanager
+def open_artifact(out_path):
+    """
+    Opens a tar stream writing into out_path, compressed according to its extension: .tar.gz (or
+    .tgz) through gzip, .tar.zst through the zstd program, or plain .tar. The artifact only
+    replaces out_path once it was written completely.
+    """
+
+    fmt = artifact_format(out_path)
+    tmp_path = out_path + '.tmp'
+    proc = None
+
+    if fmt == FORMAT_ZSTD:
+        try:
+            proc = subprocess.Popen(['zstd', '-q', '-f', '-T0', '-o', tmp_path],
+                                    stdin=subprocess.PIPE)
+        except OSError as e:
+            raise ArtifactException('Could not run zstd: {}'.format(e))
+
+        raw = None
+        stream = proc.stdin
+    elif fmt == FORMAT_GZIP:
+        raw = open(tmp_path, 'wb')
+        stream = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0)
+    else:
+        raw = open(tmp_path, 'wb')
+        stream = raw
+
+    try:
+        with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            yield tar
+
+        stream.close()
+
+        if raw is not None:
+            raw.close()
+
+        if proc is not None and proc.wait() != 0:
+            raise ArtifactException('zstd exited with status {}'.format(proc.returncode))
+
+        replace(tmp_path, out_path)
+    except BaseException:
+        if proc is not None:
+            proc.stdin.close()
+            proc.wait()
+        elif raw is not None:
+            raw.close()
+
+        if path.exists(tmp_path):
+            unlink(tmp_path)
+
+        raise
+
+
+def make_info(name, mtime):
+    info = tarfile.TarInfo(name)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+
+def write_members(tar, members):
+    """
+    Writes the members of an artifact into tar, sorted by path. `members` maps each path to one of:
+
+    - (MEMBER_DIR, ): a directory
+    - (MEMBER_BLOB, mode, sha, repo): a Git object of the given mode
+    - (MEMBER_DISK, file_path): a file, directory or symlink read from the disk
+
+    Permissions and owners are normalized, and all members get the same modification time.
+    """
+
+    mtime = source_date()
+    readers = {}
+
+    try:
+        for name in sorted(members):
+            member = members[name]
+            info = make_info(name, mtime)
+
+            if member[0] == MEMBER_DIR:
+                info.type = tarfile.DIRTYPE
+                info.mode = DIR_PERMISSIONS
+                tar.addfile(info)
+            elif member[0] == MEMBER_BLOB:
+                _, mode, sha, repo = member
+
+                if repo not in readers:
+                    readers[repo] = BlobReader(repo)
+
+                reader = readers[repo]
+                info.size = reader.open(sha)
+
+                if mode == MODE_SYMLINK:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = reader.stream.read(info.size).decode('utf-8')
+                    info.size = 0
+                    tar.addfile(info)
+                else:
+                    info.mode = FILE_PERMISSIONS.get(mode, FILE_PERMISSIONS[MODE_FILE])
+                    tar.addfile(info, reader.stream)
+
+                reader.done()
+            else:
+                file_path = member[1]
+                st = lstat(file_path)
+
+                if stat.S_ISLNK(st.st_mode):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = readlink(file_path)
+                    tar.addfile(info)
+                elif stat.S_ISDIR(st.st_mode):
+                    info.type = tarfile.DIRTYPE
+                    info.mode = DIR_PERMISSIONS
+                    tar.addfile(info)
+                else:
+                    mode = MODE_EXECUTABLE if st.st_mode & 0o100 else MODE_FILE
+                    info.mode = FILE_PERMISSIONS[mode]
+                    info.size = st.st_size
+
+                    with open(file_path, 'rb') as f:
+                        tar.addfile(info, f)
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+
+def add_parents(members):
+    """
+    Adds a directory member for each parent directory of the members
+    """
+
+    for name in list(members):
+        parent = path.dirname(name)
+
+        while parent and parent not in members:
+            members[parent] = (MEMBER_DIR, )
+            parent = path.dirname(parent)
@@ -0,0 +1,499 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import re
+import json
+import stat
+import fcntl
+import hashlib
+import tarfile
+
+from contextlib import contextmanager
+from os import path, environ, makedirs, listdir, walk, utime, rename, lstat, fstat, unlink, close
+from shutil import rmtree
+from tempfile import mkstemp
+from .plumbing import extract_tar, remove_file
+from .lazy import LazyModule
+
+git = LazyModule('git')
+
+CACHE_DIR_ENV = 'CASTOR_CACHE_DIR'
+CACHE_SIZE_ENV = 'CASTOR_CACHE_SIZE'
+USED_MARK = 'castor-last-used'
+LOCK_SUFFIX = '.lock'
+OUTPUTS_KEEP = 3
+MIRROR_REFSPECS = ['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*']
+
+SIZE_UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+
+
+class CacheException(Exception):
+    """
+    Emitted when the cache could not fulfill a request
+    """
+    pass
+
+
+def default_cache_dir():
+    """
+    Returns the machine-wide cache directory, which can be overridden by the CASTOR_CACHE_DIR
+    environment variable.
+    """
+
+    if environ.get(CACHE_DIR_ENV):
+        return environ[CACHE_DIR_ENV]
+
+    base = environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+    return path.join(base, 'castor', 'objects')
+
+
+def parse_size(size):
+    """
+    Parses a human size like "500M" or "10G" into a number of bytes.
+    """
+
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$', str(size), re.IGNORECASE)
+
+    if m is None:
+        raise ValueError('Invalid size "{}"'.format(size))
+
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def format_size(size):
+    """
+    Opposite of parse_size(), for display.
+    """
+
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit]:
+            return '{:.1f}{}'.format(size / SIZE_UNITS[unit], unit)
+
+    return '{}'.format(size)
+
+
+def normalize_url(url):
+    """
+    Normalizes a Git URL so that different spellings of the same upstream share the same cache
+    entry. By example, "git@github.com:Foo/bar.git" and "https://github.com/Foo/bar" both become
+    "github.com/Foo/bar".
+    """
+
+    url = url.strip()
+
+    if url.startswith('file://'):
+        out = path.realpath(url[len('file://'):])
+    else:
+        m = re.match(r'^\w+://(?:[^@/]+@)?([^/:]+)(?::\d+)?/*(.*)$', url) \
+            or re.match(r'^(?:[^@/]+@)?([^/:]+):/*(.*)$', url)
+
+        if m is None:
+            out = path.realpath(url)
+        else:
+            out = '{}/{}'.format(m.group(1).lower(), m.group(2))
+
+    out = out.rstrip('/')
+
+    if out.endswith('.git'):
+        out = out[:-len('.git')]
+
+    return out.rstrip('/')
+
+
+def cache_key(url):
+    """
+    Returns the name of the cache entry for a given URL. It is human-readable but with a hash
+    suffix, in order to avoid collisions between sanitized names.
+    """
+
+    normalized = normalize_url(url)
+    digest = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+    name = re.sub(r'[^\w.-]+', '_', normalized).strip('_')[-80:]
+
+    return '{}-{}.git'.format(name, digest)
+
+
+class MirrorLock(object):
+    """
+    Inter-process lock on a cache entry, so that several Castor instances can share the same
+    cache safely.
+    """
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.fd = None
+
+    def __enter__(self):
+        while True:
+            self.fd = open(self.lock_path, 'a')
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+            # The lock file might have been removed while waiting for it, see remove()
+            try:
+                if path.samestat(fstat(self.fd.fileno()), lstat(self.lock_path)):
+                    return self
+            except FileNotFoundError:
+                pass
+
+            self.fd.close()
+
+    def remove(self):
+        """
+        Removes the lock file, which must be done while holding the lock. Processes that were
+        waiting for it then retry with a new lock file.
+        """
+
+        unlink(self.lock_path)
+
+    def share(self):
+        """
+        Turns the lock into a shared one, which other processes can hold at the same time. The
+        conversion is not atomic: another process can take the lock in between.
+        """
+
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+        self.fd = None
+
+
+class ObjectCache(object):
+    """
+    A machine-wide cache of bare mirrors of the upstream repositories, shared by all Castor
+    projects. Lodge clones are made from those mirrors, so that they only have to fetch the
+    objects that are missing from the cache.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        self.root = root or default_cache_dir()
+
+        if max_size is None and environ.get(CACHE_SIZE_ENV):
+            max_size = parse_size(environ[CACHE_SIZE_ENV])
+
+        self.max_size = max_size
+
+    def mirror_path(self, url):
+        return path.join(self.root, cache_key(url))
+
+    def lock(self, mirror_path):
+        return MirrorLock(mirror_path + LOCK_SUFFIX)
+
+    @staticmethod
+    def touch(mirror_path):
+        mark = path.join(mirror_path, USED_MARK)
+
+        with open(mark, 'a'):
+            pass
+
+        utime(mark, None)
+
+    @contextmanager
+    def ensure(self, url):
+        """
+        Makes sure that an up-to-date mirror of the given URL exists in the cache and gives its
+        path. The mirror stays locked (shared with the other users of the mirror) until the block
+        exits, so that it is not removed while it is being cloned.
+        """
+
+        makedirs(self.root, exist_ok=True)
+        mirror_path = self.mirror_path(url)
+        created = False
+
+        with self.lock(mirror_path) as lock:
+            try:
+                if path.exists(mirror_path):
+                    git.Git(mirror_path).remote('update', '--prune')
+                else:
+                    tmp_path = mirror_path + '.tmp'
+
+                    if path.exists(tmp_path):
+                        rmtree(tmp_path)
+
+                    # Not a --mirror, which would also fetch refs such as the pull requests
+                    git.Git().clone('--bare', url, tmp_path)
+                    g = git.Git(tmp_path)
+
+                    for i, refspec in enumerate(MIRROR_REFSPECS):
+                        g.config('--add' if i else '--replace-all', 'remote.origin.fetch', refspec)
+
+                    g.config('uploadpack.allowFilter', 'true')
+                    g.config('uploadpack.allowAnySHA1InWant', 'true')
+                    rename(tmp_path, mirror_path)
+                    created = True
+            except git.GitCommandError as e:
+                raise CacheException('Could not mirror "{}": {}'.format(url, e))
+
+            self.touch(mirror_path)
+            lock.share()
+
+            if not path.isdir(mirror_path):
+                raise CacheException('The mirror of "{}" was removed meanwhile'.format(url))
+
+            yield mirror_path
+
+        # Outside of the lock, two processes pruning each other's mirror would wait forever
+        if created and self.max_size is not None:
+            self.prune(keep={mirror_path})
+
+    def mirrors(self):
+        """
+        Lists the mirrors from the cache, as (path, url, size, last used time) tuples, the least
+        recently used first.
+        """
+
+        out = []
+
+        if not path.isdir(self.root):
+            return out
+
+        for name in listdir(self.root):
+            mirror_path = path.join(self.root, name)
+
+            if not name.endswith('.git') or not path.isdir(mirror_path):
+                continue
+
+            mark = path.join(mirror_path, USED_MARK)
+            last_used = path.getmtime(mark) if path.exists(mark) else 0
+
+            try:
+                url = git.Git(mirror_path).config('remote.origin.url')
+            except git.GitCommandError:
+                url = None
+
+            out.append((mirror_path, url, dir_size(mirror_path), last_used))
+
+        return sorted(out, key=lambda x: x[3])
+
+    def refresh(self):
+        """
+        Fetches all the mirrors from their upstream. Returns the list of URLs that failed.
+        """
+
+        failed = []
+
+        for mirror_path, url, _, _ in self.mirrors():
+            with self.lock(mirror_path):
+                try:
+                    git.Git(mirror_path).remote('update', '--prune')
+                except git.GitCommandError:
+                    failed.append(url or mirror_path)
+
+        return failed
+
+    def prune(self, max_size=None, keep=frozenset()):
+        """
+        Removes broken mirrors, then evicts the least recently used mirrors until the cache fits
+        into max_size (defaults to the cache's max size). Mirrors from `keep` are never evicted.
+        Returns the paths of removed mirrors.
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+
+        mirrors = []
+        removed = []
+
+        for mirror in self.mirrors():
+            if mirror[1] is None:
+                self.remove(mirror[0])
+                removed.append(mirror[0])
+            else:
+                mirrors.append(mirror)
+
+        if max_size is None:
+            return removed
+
+        total = sum(x[2] for x in mirrors)
+
+        for mirror_path, _, size, _ in mirrors:
+            if total <= max_size:
+                break
+
+            if mirror_path in keep:
+                continue
+
+            self.remove(mirror_path)
+            removed.append(mirror_path)
+            total -= size
+
+        return removed
+
+    def remove(self, mirror_path):
+        """
+        Removes a mirror along with its lock file, once nobody uses it anymore
+        """
+
+        with self.lock(mirror_path) as lock:
+            rmtree(mirror_path)
+            lock.remove()
+
+    def clear(self):
+        """
+        Removes all the mirrors from the cache.
+        """
+
+        return self.prune(max_size=0)
+
+
+def dir_size(dir_path):
+    """
+    Total size of the files inside of a directory
+    """
+
+    total = 0
+
+    for root, _, file_names in walk(dir_path):
+        for file_name in file_names:
+            try:
+                total += path.getsize(path.join(root, file_name))
+            except OSError:
+                pass
+
+    return total
+
+
+def snapshot(dir_path):
+    """
+    Maps each path inside of a directory to a signature of its metadata. Comparing two snapshots
+    of the same directory tells what was changed in between, without reading any file.
+    """
+
+    out = {}
+
+    for root, dir_names, file_names in walk(dir_path):
+        for name in dir_names + file_names:
+            full = path.join(root, name)
+            st = lstat(full)
+
+            if stat.S_ISDIR(st.st_mode):
+                sig = (st.st_mode, )
+            else:
+                sig = (st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+            out[path.relpath(full, dir_path)] = sig
+
+    return out
+
+
+class OutputCache(object):
+    """
+    A cache of what post freeze commands did to their target. Each entry is stored under a key
+    identifying everything the commands depend on, and holds the files they created or modified
+    (as a tar archive) as well as the list of files they removed.
+
+    Only the `keep` most recently used entries of each target are kept.
+    """
+
+    def __init__(self, root, keep=OUTPUTS_KEEP):
+        self.root = root
+        self.keep = keep
+
+    def entry_paths(self, key):
+        base = path.join(self.root, key)
+        return base + '.tar', base + '.json'
+
+    def replay(self, key, dest):
+        """
+        Applies the changes stored under key to dest. Returns False if there is no such entry, in
+        which case nothing was done.
+        """
+
+        tar_path, meta_path = self.entry_paths(key)
+
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+
+            archive = open(tar_path, 'rb')
+        except (IOError, ValueError):
+            return False
+
+        with archive:
+            for rel in meta['deleted']:
+                full = path.join(dest, rel)
+
+                if path.isdir(full) and not path.islink(full):
+                    rmtree(full)
+                else:
+                    remove_file(full)
+
+            extract_tar(archive, dest)
+
+        utime(meta_path, None)
+        return True
+
+    def store(self, key, target, src, before):
+        """
+        Stores the changes made to src since the `before` snapshot under key. The entry belongs
+        to `target`, older entries of which are then evicted.
+        """
+
+        after = snapshot(src)
+        changed = sorted(k for k, v in after.items() if before.get(k) != v)
+        deleted = set()
+
+        for rel in sorted(set(before) - set(after)):
+            parent = path.dirname(rel)
+
+            while parent and parent not in deleted:
+                parent = path.dirname(parent)
+
+            if not parent:
+                deleted.add(rel)
+
+        makedirs(self.root, exist_ok=True)
+        tar_path, meta_path = self.entry_paths(key)
+
+        fd, tmp_path = mkstemp(dir=self.root, suffix='.tmp')
+        close(fd)
+
+        with tarfile.open(tmp_path, 'w') as t:
+            for rel in changed:
+                t.add(path.join(src, rel), rel, recursive=False)
+
+        rename(tmp_path, tar_path)
+
+        fd, tmp_path = mkstemp(dir=self.root, suffix='.tmp')
+        close(fd)
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'target': target, 'deleted': sorted(deleted)}, f)
+
+        rename(tmp_path, meta_path)
+        self.prune(target)
+
+    def prune(self, target):
+        """
+        Removes the least recently used entries of a target, beyond the `keep` most recent ones.
+        """
+
+        entries = []
+
+        for name in listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+
+            meta_path = path.join(self.root, name)
+
+            try:
+                with open(meta_path, 'r') as f:
+                    if json.load(f).get('target') == target:
+                        entries.append((path.getmtime(meta_path), name[:-len('.json')]))
+            except (IOError, ValueError):
+                pass
+
+        for _, key in sorted(entries, reverse=True)[self.keep:]:
+            for entry_path in self.entry_paths(key):
+                if path.exists(entry_path):
+                    unlink(entry_path)
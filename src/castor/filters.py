@@ -0,0 +1,111 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import re
+
+from functools import lru_cache
+
+
+def translate(pattern):
+    """
+    Translates a glob into a regular expression. `*`, `?` and `[...]` do not match slashes, while
+    `**` matches any number of directories.
+    """
+
+    out = []
+    i = 0
+
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            content = pattern[i + 1:end]
+
+            if content.startswith('!'):
+                content = '^' + content[1:]
+
+            out.append('[{}]'.format(content.replace('\\', '\\\\')))
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+
+    return ''.join(out)
+
+
+def pattern_regex(pattern):
+    """
+    Returns the regular expression matching the paths a pattern applies to:
+
+    - a pattern without a slash matches the name of a file or of any of its parent directories
+      (eg: `tests` or `*.md`)
+    - other patterns match from the root (eg: `/docs` or `vendor/*/tests`)
+    - a pattern matching a directory applies to everything inside of it, and a trailing slash
+      makes it only match directories
+    """
+
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+
+    if '/' in pattern:
+        head = '^'
+        pattern = pattern.lstrip('/')
+    else:
+        head = '^(?:.*/)?'
+
+    return '{}{}{}$'.format(head, translate(pattern), '/.*' if dir_only else '(?:/.*)?')
+
+
+def compile_patterns(patterns):
+    """
+    Compiles a list of patterns into a single regular expression, or None if there is none
+    """
+
+    if not patterns:
+        return None
+
+    return re.compile('|'.join('(?:{})'.format(pattern_regex(x)) for x in patterns), re.DOTALL)
+
+
+class PathFilter(object):
+    """
+    Tells which files to keep, given exclude and include patterns (see pattern_regex()): files
+    matching an exclude pattern are dropped, unless they also match an include pattern.
+    """
+
+    def __init__(self, exclude=(), include=()):
+        self.exclude = compile_patterns(exclude)
+        self.include = compile_patterns(include)
+
+    def __bool__(self):
+        return self.exclude is not None
+
+    def accept(self, file_path):
+        if self.exclude is None or not self.exclude.match(file_path):
+            return True
+
+        return self.include is not None and self.include.match(file_path) is not None
+
+
+@lru_cache(maxsize=None)
+def path_filter(exclude=(), include=()):
+    """
+    Returns the PathFilter of a set of patterns, which is only compiled once. Patterns must be
+    given as tuples.
+    """
+
+    return PathFilter(exclude, include)
@@ -0,0 +1,30 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import importlib
+
+from threading import Lock
+
+
+class LazyModule(object):
+    """
+    Stands for a module which is only imported when one of its attributes is first accessed.
+    GitPython and jsonschema make most of the start up time of Castor, while many commands only
+    need them in some cases.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
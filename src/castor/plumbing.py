@@ -0,0 +1,936 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import re
+import glob
+import fcntl
+import fnmatch
+import hashlib
+import tarfile
+import subprocess
+
+from binascii import unhexlify
+from shutil import copyfile, copymode, copy2
+from stat import S_ISREG
+from os import path, makedirs, unlink, symlink, chmod, rmdir, listdir, link, readlink, \
+    walk, replace, stat, lstat, curdir
+from .lazy import LazyModule
+from .pool import run_dag
+
+git = LazyModule('git')
+
+MODE_FILE = '100644'
+MODE_EXECUTABLE = '100755'
+MODE_SYMLINK = '120000'
+MODE_GITLINK = '160000'
+
+# Same permissions as what "git archive" produces with the default tar.umask
+FILE_PERMISSIONS = {
+    MODE_FILE: 0o664,
+    MODE_EXECUTABLE: 0o775,
+}
+
+# ioctl to make a copy-on-write clone of a file (Linux btrfs/XFS)
+FICLONE = 0x40049409
+
+LINK_COPY = 'copy'
+LINK_REFLINK = 'reflink'
+LINK_HARDLINK = 'hardlink'
+LINK_METHODS = (LINK_COPY, LINK_REFLINK, LINK_HARDLINK)
+
+# Git archives are trusted, keep the same behavior on all Python versions
+EXTRACT_KWARGS = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+
+
+def split_z(output):
+    """
+    Splits the output of a git command called with -z
+    """
+
+    return [x for x in output.split('\0') if x]
+
+
+def ls_tree(repo, treeish):
+    """
+    Lists all the files of a tree, recursively. Returns a dictionary mapping each path to its
+    (mode, sha) tuple.
+    """
+
+    out = {}
+
+    for entry in split_z(repo.git.ls_tree('-r', '-z', '--full-tree', treeish)):
+        meta, file_path = entry.split('\t', 1)
+        mode, _, sha = meta.split(' ')
+        out[file_path] = (mode, sha)
+
+    return out
+
+
+def diff_tree(repo, old, new):
+    """
+    Lists the files that differ between two trees, as (old mode, new mode, old sha, new sha,
+    status, path) tuples. Renames are reported as a deletion and an addition.
+    """
+
+    items = split_z(repo.git.diff_tree('-r', '-z', '--no-renames', old, new))
+
+    for meta, file_path in zip(items[::2], items[1::2]):
+        old_mode, new_mode, old_sha, new_sha, status = meta.lstrip(':').split(' ')
+        yield old_mode, new_mode, old_sha, new_sha, status, file_path
+
+
+def extract_archive(repo, dest, treeish='HEAD', accept=None):
+    """
+    Extracts the content of treeish into dest. The archive is read from git as it is produced and
+    each file is written immediately, so that neither the archive nor the list of its members
+    are ever held entirely on disk or in memory.
+
+    If given, accept(name) tells if a member of the archive should be extracted. Directories left
+    empty, because all their files were filtered out by accept or by export-ignore attributes,
+    are removed.
+    """
+
+    proc = repo.git.archive('--format=tar', treeish, as_process=True)
+
+    try:
+        dirs = extract_tar(proc.stdout, dest, accept)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    for dir_path in sorted(dirs, reverse=True):
+        prune_empty_dirs(path.join(dest, dir_path), dest)
+
+
+def extract_tar(fileobj, dest, accept=None):
+    """
+    Extracts a tar stream into dest, member by member. Existing files are replaced rather than
+    written through, since they may be hardlinked to another file.
+
+    Returns the set of the directory members which were extracted.
+    """
+
+    dirs = set()
+
+    with tarfile.open(fileobj=fileobj, mode='r|') as t:
+        for member in t:
+            if accept is None or accept(member.name):
+                if member.isdir():
+                    dirs.add(member.name)
+                else:
+                    remove_file(path.join(dest, member.name))
+
+                t.extract(member, dest, **EXTRACT_KWARGS)
+
+            # In stream mode, TarFile keeps track of all the members it has seen
+            t.members = []
+
+    return dirs
+
+
+def has_attributes(repo, files):
+    """
+    Tells if a repo has Git attributes, given the files of its tree
+    """
+
+    return path.exists(path.join(repo.git_dir, 'info', 'attributes')) \
+        or any(path.basename(x) == '.gitattributes' for x in files)
+
+
+def export_ignored(repo, files):
+    """
+    Returns the set of files which "git archive" leaves out because of the export-ignore
+    attribute, set on them or on one of their parent directories. Attributes are read from the
+    index, in a single "git check-attr" call, and only if the repo has any.
+    """
+
+    if not has_attributes(repo, files):
+        return set()
+
+    return check_export_ignore(repo, files)
+
+
+def check_export_ignore(repo, files):
+    """
+    Same as export_ignored(), but always asks git, so that files can be only a few paths of the
+    tree rather than all of them.
+    """
+
+    dirs = set()
+
+    for file_path in files:
+        parent = path.dirname(file_path)
+
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = path.dirname(parent)
+
+    # Directories are given with a trailing slash, so that the patterns only matching directories
+    # apply to them, as they do in "git archive"
+    paths = sorted(set(files)) + sorted(x + '/' for x in dirs)
+
+    if not paths:
+        return set()
+
+    out = split_z(run_git(repo, ['check-attr', '--cached', '-z', '--stdin', 'export-ignore'],
+                          ''.join(x + '\0' for x in paths).encode()).decode())
+    ignored_paths = {x.rstrip('/') for x, value in zip(out[::3], out[2::3]) if value == 'set'}
+
+    if not ignored_paths:
+        return set()
+
+    def ignored(file_path):
+        while file_path:
+            if file_path in ignored_paths:
+                return True
+
+            file_path = path.dirname(file_path)
+
+        return False
+
+    return {x for x in files if ignored(x)}
+
+
+def link_tree(repo, dest, method, accept=None):
+    """
+    Materializes the HEAD of repo into dest using the files of its working tree, which are
+    reflinked or hardlinked according to `method` when possible.
+
+    This is only done when the working tree is clean and has no Git attributes that could make
+    its files differ from what "git archive" would produce. Returns False if it was not the case,
+    and nothing was done.
+    """
+
+    files = ls_tree(repo, 'HEAD')
+
+    if has_attributes(repo, files) \
+            or repo.is_dirty(index=True, working_tree=True, untracked_files=False):
+        return False
+
+    created = set()
+
+    for file_path, (mode, _) in files.items():
+        if mode == MODE_GITLINK or (accept is not None and not accept(file_path)):
+            continue
+
+        target = path.join(dest, file_path)
+        target_dir = path.dirname(target)
+
+        if target_dir not in created:
+            makedirs(target_dir, exist_ok=True)
+            created.add(target_dir)
+
+        materialize(path.join(repo.working_tree_dir, file_path), target, method)
+
+    return True
+
+
+def materialize(src, dest, method=LINK_COPY):
+    """
+    Makes dest a copy of src. Depending on `method`, the data can be shared with src through a
+    reflink or a hardlink. If this is not supported, a regular copy is made.
+    """
+
+    remove_file(dest)
+
+    if path.islink(src):
+        symlink(readlink(src), dest)
+        return
+
+    if method == LINK_HARDLINK:
+        try:
+            link(src, dest)
+            return
+        except OSError:
+            pass
+    elif method == LINK_REFLINK:
+        try:
+            reflink(src, dest)
+            copymode(src, dest)
+            return
+        except OSError:
+            remove_file(dest)
+
+    copyfile(src, dest)
+    copymode(src, dest)
+
+
+def reflink(src, dest):
+    """
+    Makes dest a copy-on-write clone of src. Raises OSError if the file system does not support
+    it.
+    """
+
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class RefIndex(object):
+    """
+    Index of all the refs of a repo, built from a single "git for-each-ref" call. Annotated tags
+    are peeled to the commit they point to.
+    """
+
+    PREFIXES = ('refs/tags/', 'refs/heads/', 'refs/remotes/')
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.by_name = {}
+        self.by_commit = {}
+
+        out = repo.git.for_each_ref('--format=%(objectname) %(*objectname) %(refname)')
+
+        for line in out.splitlines():
+            sha, peeled, ref_name = line.split(' ', 2)
+            commit = peeled or sha
+
+            self.by_name[ref_name] = commit
+            self.by_commit.setdefault(commit, []).append(ref_name)
+
+    @classmethod
+    def short_name(cls, ref_name):
+        for prefix in cls.PREFIXES:
+            if ref_name.startswith(prefix):
+                return ref_name[len(prefix):]
+
+        return ref_name
+
+    def names(self, commit):
+        """
+        Short names of all the refs pointing to commit
+        """
+
+        return [self.short_name(x) for x in self.by_commit.get(commit, [])]
+
+    def tags(self, commit):
+        """
+        Names of the tags pointing to commit, sorted
+        """
+
+        return sorted(self.short_name(x) for x in self.by_commit.get(commit, [])
+                      if x.startswith('refs/tags/'))
+
+    def resolve(self, version):
+        """
+        Returns the commit SHA that version (a ref name or a commit SHA) points to, or None if it
+        does not exist locally.
+        """
+
+        for ref_name in (version, 'refs/tags/' + version, 'refs/heads/' + version,
+                         'refs/remotes/' + version, 'refs/remotes/origin/' + version):
+            if ref_name in self.by_name:
+                return self.by_name[ref_name]
+
+        if re.match(r'^[0-9a-f]{4,40}$', version):
+            try:
+                return self.repo.git.rev_parse('--verify', '--quiet', version + '^{commit}')
+            except git.GitCommandError:
+                pass
+
+
+def git_dir(repo_path):
+    """
+    Returns the Git directory of a working tree, following "gitdir:" files (as found in
+    submodules). Returns None if there is none.
+    """
+
+    dot_git = path.join(repo_path, '.git')
+
+    if path.isdir(dot_git):
+        return dot_git
+    elif path.isfile(dot_git):
+        with open(dot_git, 'r') as f:
+            content = f.read().strip()
+
+        if content.startswith('gitdir:'):
+            return path.normpath(path.join(repo_path, content[len('gitdir:'):].strip()))
+
+
+def read_gitmodules(repo_path):
+    """
+    Parses the .gitmodules file of a working tree without spawning git. Returns a dictionary
+    mapping the name of each submodule to its settings (path, url, ...).
+    """
+
+    modules = {}
+    current = None
+
+    try:
+        with open(path.join(repo_path, '.gitmodules'), 'r') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return modules
+
+    for line in lines:
+        line = line.strip()
+
+        if not line or line.startswith(('#', ';')):
+            continue
+
+        m = re.match(r'^\[\s*submodule\s+"((?:[^"\\]|\\.)*)"\s*\]$', line)
+
+        if m is not None:
+            current = modules.setdefault(m.group(1), {})
+        elif line.startswith('['):
+            current = None
+        elif current is not None and '=' in line:
+            key, value = line.split('=', 1)
+            value = value.strip()
+
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+
+            current[key.strip().lower()] = value
+
+    return modules
+
+
+def submodule_paths(repo_path):
+    """
+    Lists the paths (relative to repo_path) of the submodules of a working tree, as declared by
+    its .gitmodules. Only the submodules which are checked out, and thus have a gitlink to their
+    own Git directory, are returned.
+    """
+
+    return sorted(
+        x['path'].strip('/') for x in read_gitmodules(repo_path).values()
+        if x.get('path') and git_dir(path.join(repo_path, x['path'])) is not None
+    )
+
+
+def read_gitlink(repo_path, sub_path):
+    """
+    Returns the commit that the HEAD of a working tree pins the submodule at sub_path to, or None
+    if there is no such gitlink.
+    """
+
+    out = run_git_in(repo_path, ['ls-tree', '-z', 'HEAD', '--', sub_path])
+
+    for entry in split_z(out.decode('utf-8', 'replace')):
+        meta, _ = entry.split('\t', 1)
+        mode, _, sha = meta.split(' ')
+
+        if mode == MODE_GITLINK:
+            return sha
+
+    return None
+
+
+def read_ref(git_path, ref_name):
+    """
+    Reads the SHA a ref points to, from its loose file or from packed-refs, without spawning git.
+    Returns None if the ref does not exist.
+    """
+
+    try:
+        with open(path.join(git_path, ref_name), 'r') as f:
+            content = f.read().strip()
+
+        if content.startswith('ref:'):
+            return read_ref(git_path, content[len('ref:'):].strip())
+
+        return content
+    except IOError:
+        pass
+
+    try:
+        with open(path.join(git_path, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+
+                parts = line.strip().split(' ', 1)
+
+                if len(parts) == 2 and parts[1] == ref_name:
+                    return parts[0]
+    except IOError:
+        pass
+
+
+def read_head(repo_path):
+    """
+    Reads the HEAD of a working tree directly from its files. Returns a (ref name, sha) tuple,
+    the ref name being None when the HEAD is detached and the SHA being None if the repo does not
+    exist or has no commit.
+    """
+
+    git_path = git_dir(repo_path)
+
+    try:
+        with open(path.join(git_path, 'HEAD'), 'r') as f:
+            content = f.read().strip()
+    except (IOError, TypeError):
+        return None, None
+
+    if content.startswith('ref:'):
+        ref_name = content[len('ref:'):].strip()
+        return ref_name, read_ref(git_path, ref_name)
+
+    return None, content
+
+
+def file_digest(file_path):
+    """
+    SHA-1 of the content of a file
+    """
+
+    h = hashlib.sha1()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def path_digest(file_path):
+    """
+    SHA-1 of a file, or of the names and contents of all the files inside of a directory. Returns
+    None if the path does not exist.
+    """
+
+    if path.isfile(file_path):
+        return file_digest(file_path)
+    elif not path.isdir(file_path):
+        return None
+
+    h = hashlib.sha1()
+
+    for root, dir_names, file_names in walk(file_path):
+        dir_names.sort()
+
+        for file_name in sorted(file_names):
+            full = path.join(root, file_name)
+            h.update('{}\0{}\0'.format(path.relpath(full, file_path), path_digest(full)).encode())
+
+    return h.hexdigest()
+
+
+def files_digest(files):
+    """
+    SHA-1 of the files of a file target (see list_sources()), which matches path_digest() of its
+    source when it is a file or a directory. Missing files are hashed as None.
+    """
+
+    if set(files) == {''}:
+        return path_digest(files[''])
+
+    h = hashlib.sha1()
+
+    for rel_path, file_path in sorted(files.items()):
+        h.update('{}\0{}\0'.format(rel_path, path_digest(file_path)).encode())
+
+    return h.hexdigest()
+
+
+def list_dir_files(dir_path):
+    """
+    Lists the files inside of a directory, recursively, as a dictionary mapping their path
+    relative to dir_path to their full path.
+    """
+
+    out = {}
+
+    for root, dir_names, file_names in walk(dir_path):
+        for file_name in file_names:
+            full = path.join(root, file_name)
+            out[path.relpath(full, dir_path)] = full
+
+    return out
+
+
+def list_sources(source_path):
+    """
+    Lists the files copied by a file target, as a dictionary mapping their path relative to the
+    target to their path on the disk:
+
+    - a file is copied to the target itself, and maps to ''
+    - a directory is copied into the target, with all the files inside of it
+    - a glob (where ** matches any number of directories) copies the files it matches into the
+      target, as well as the files inside of the directories it matches, relative to the last
+      directory before the first wildcard
+    """
+
+    if not glob.has_magic(source_path):
+        if path.isdir(source_path):
+            return list_dir_files(source_path)
+
+        return {'': source_path}
+
+    parts = source_path.split(path.sep)
+    first = min(i for i, x in enumerate(parts) if glob.has_magic(x))
+    base = path.sep.join(parts[:first])
+    out = {}
+
+    for match in glob_paths(base, parts[first:]):
+        if path.isdir(match):
+            for full in list_dir_files(match).values():
+                out[path.relpath(full, base)] = full
+        elif path.isfile(match):
+            out[path.relpath(match, base)] = match
+
+    return out
+
+
+def glob_paths(base, parts):
+    """
+    Yields the paths below base which match the components of a glob pattern, "**" matching any
+    number of directories. This is what glob.glob(recursive=True) does, which Python 3.4 lacks.
+    As with glob, hidden files are only matched by components starting with a dot.
+    """
+
+    if not parts:
+        yield base
+        return
+
+    head, rest = parts[0], parts[1:]
+
+    if head == '**':
+        for root, dir_names, file_names in walk(base or curdir):
+            dir_names[:] = sorted(x for x in dir_names if not x.startswith('.'))
+            current = path.normpath(path.join(base, path.relpath(root, base or curdir)))
+
+            for match in glob_paths(current, rest):
+                yield match
+
+            if not rest:
+                for file_name in sorted(file_names):
+                    if not file_name.startswith('.'):
+                        yield path.join(current, file_name)
+    elif glob.has_magic(head):
+        try:
+            names = sorted(listdir(base or curdir))
+        except OSError:
+            return
+
+        for name in names:
+            if fnmatch.fnmatch(name, head) and (head.startswith('.') or not name.startswith('.')):
+                for match in glob_paths(path.join(base, name), rest):
+                    yield match
+    elif path.lexists(path.join(base, head)):
+        for match in glob_paths(path.join(base, head), rest):
+            yield match
+
+
+def same_file(src, dest):
+    """
+    Tells if dest is a copy of src: they have the same size and either the same modification time
+    (which copies keep) or the same content.
+    """
+
+    try:
+        src_info = stat(src)
+        dest_info = lstat(dest)
+    except OSError:
+        return False
+
+    if not S_ISREG(dest_info.st_mode) or src_info.st_size != dest_info.st_size:
+        return False
+
+    return src_info.st_mtime_ns == dest_info.st_mtime_ns or file_digest(src) == file_digest(dest)
+
+
+def sync_files(files, dest, previous=(), jobs=1):
+    """
+    Copies the files of a file target (see list_sources()) into dest, by up to `jobs` workers.
+    Files whose copy is already up to date are skipped (see same_file()), and the files from
+    `previous` which are not in `files` anymore are removed.
+
+    Returns the sorted list of files that were copied.
+    """
+
+    def dest_path(rel_path):
+        return path.join(dest, rel_path) if rel_path else dest
+
+    for rel_path in sorted(set(previous) - set(files)):
+        remove_file(dest_path(rel_path))
+        prune_empty_dirs(path.dirname(dest_path(rel_path)), dest)
+
+    copied = []
+
+    def copy(rel_path):
+        file_path = dest_path(rel_path)
+
+        if same_file(files[rel_path], file_path):
+            return
+
+        makedirs(path.dirname(file_path), exist_ok=True)
+
+        # The copy might be hardlinked to a lodge file, don't write through it
+        remove_file(file_path)
+        copy2(files[rel_path], file_path)
+        copied.append(rel_path)
+
+    errors = run_dag(sorted(files), {}, copy, jobs)
+
+    if errors:
+        raise errors[0][1]
+
+    return sorted(copied)
+
+
+def run_git(repo, args, data=None):
+    """
+    Runs a git command in repo, feeding it data on its standard input, and returns its raw
+    output. Used for plumbing commands that read their input from stdin.
+    """
+
+    return run_git_in(repo.working_dir, args, data)
+
+
+def run_git_in(repo_path, args, data=None):
+    """
+    Same as run_git(), for a repo given by its path, which spares opening it with GitPython
+    """
+
+    command = ['git'] + list(args)
+    proc = subprocess.Popen(command, cwd=repo_path, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+
+    if proc.returncode != 0:
+        raise git.GitCommandError(command, proc.returncode, err)
+
+    return out
+
+
+def worktree_status(repo_path):
+    """
+    Tells if a working tree has uncommitted changes and if it has untracked files, through a
+    single "git status" call. Submodules are ignored, as they are looked at on their own. Returns
+    a (dirty, untracked) tuple.
+    """
+
+    out = run_git_in(repo_path, ['status', '--porcelain', '-z', '--ignore-submodules=all'])
+    dirty = untracked = False
+    entries = iter(split_z(out.decode('utf-8', 'replace')))
+
+    for entry in entries:
+        if entry.startswith('??'):
+            untracked = True
+        else:
+            dirty = True
+
+            # Renames and copies are followed by their original path
+            if entry[0] in 'RC':
+                next(entries, None)
+
+    return dirty, untracked
+
+
+def unstaged_changes(repo_path, prefix):
+    """
+    Tells if the files below prefix differ from the index of the repo, ie if they were modified,
+    deleted or added since they were last staged.
+    """
+
+    out = run_git_in(repo_path, ['status', '--porcelain', '-z', '--untracked-files=all', '--',
+                                 prefix])
+    entries = iter(split_z(out.decode('utf-8', 'replace')))
+
+    for entry in entries:
+        # The second column compares the working tree to the index
+        if entry[1] != ' ':
+            return True
+
+        if entry[0] in 'RC':
+            next(entries, None)
+
+    return False
+
+
+def ahead_behind(repo_path, base, head):
+    """
+    Counts the commits of head which are not in base, and the other way around. Returns an
+    (ahead, behind) tuple, or None if base or head are not in the repo.
+    """
+
+    try:
+        out = run_git_in(repo_path, ['rev-list', '--left-right', '--count',
+                                     '{}...{}'.format(base, head)])
+    except git.GitCommandError:
+        return None
+
+    behind, ahead = out.decode().split()
+    return int(ahead), int(behind)
+
+
+def missing_objects(repo, shas):
+    """
+    Returns the set of objects from shas which are not in the repo's database
+    """
+
+    shas = sorted(set(shas))
+
+    if not shas:
+        return set()
+
+    out = run_git(repo, ['cat-file', '--batch-check'], ''.join(x + '\n' for x in shas).encode())
+
+    return {x.split(' ')[0] for x in out.decode().splitlines() if x.endswith(' missing')}
+
+
+def copy_objects(src, dest, shas):
+    """
+    Copies the given objects from the src repo to the dest repo, as a single pack. Objects that
+    already exist in dest are not copied.
+    """
+
+    missing = missing_objects(dest, shas)
+
+    if not missing:
+        return
+
+    pack = subprocess.Popen(['git', 'pack-objects', '--stdout', '-q'], cwd=src.working_dir,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    index = subprocess.Popen(['git', 'index-pack', '--stdin'], cwd=dest.working_dir,
+                             stdin=pack.stdout, stdout=subprocess.DEVNULL)
+    pack.stdout.close()
+    pack.stdin.write(''.join(x + '\n' for x in sorted(missing)).encode())
+    pack.stdin.close()
+
+    if pack.wait() != 0 or index.wait() != 0:
+        raise git.GitCommandError(['git', 'pack-objects'], pack.returncode or index.returncode)
+
+
+def hash_files(repo, file_paths):
+    """
+    Writes the given files as blobs into the repo's database and returns their SHAs
+    """
+
+    if not file_paths:
+        return []
+
+    out = run_git(repo, ['hash-object', '-w', '--stdin-paths'],
+                  ''.join(x + '\n' for x in file_paths).encode())
+
+    return out.decode().split()
+
+
+def ls_index(repo, prefix):
+    """
+    Lists the index entries below prefix. Returns a dictionary mapping each path, relative to
+    prefix, to its (mode, sha) tuple.
+    """
+
+    prefix = prefix.rstrip('/') + '/'
+    out = {}
+
+    for item in split_z(run_git(repo, ['ls-files', '-s', '-z', '--', prefix]).decode()):
+        meta, file_path = item.split('\t', 1)
+        mode, sha, _ = meta.split(' ')
+        out[file_path[len(prefix):]] = (mode, sha)
+
+    return out
+
+
+def update_index(repo, prefix, entries):
+    """
+    Makes the index entries below prefix match entries, a dictionary mapping paths relative to
+    prefix to (mode, sha) tuples. Only the entries that changed are written, in a single
+    update-index call, and no file is read from the working tree.
+    """
+
+    prefix = prefix.rstrip('/') + '/'
+    current = ls_index(repo, prefix)
+    lines = []
+
+    for rel_path in current:
+        if rel_path not in entries:
+            lines.append('0 {}\t{}'.format('0' * 40, prefix + rel_path))
+
+    for rel_path, (mode, sha) in sorted(entries.items()):
+        if current.get(rel_path) != (mode, sha):
+            lines.append('{} {}\t{}'.format(mode, sha, prefix + rel_path))
+
+    if lines:
+        run_git(repo, ['update-index', '-z', '--index-info'],
+                ''.join(x + '\0' for x in lines).encode())
+
+
+def skipped_worktree(repo, prefix):
+    """
+    Lists the index entries below prefix which have the skip-worktree bit set
+    """
+
+    out = run_git(repo, ['ls-files', '-t', '-z', '--', prefix]).decode()
+    return [x[2:] for x in split_z(out) if x.startswith('S ')]
+
+
+def skip_worktree(repo, paths, skip=True):
+    """
+    Sets (or clears, if `skip` is False) the skip-worktree bit of the given index entries, which
+    makes Git ignore their files on the disk, in a single update-index call.
+    """
+
+    if paths:
+        flag = '--skip-worktree' if skip else '--no-skip-worktree'
+        run_git(repo, ['update-index', flag, '-z', '--stdin'], '\0'.join(paths).encode())
+
+
+def write_blob(repo, sha, mode, dest):
+    """
+    Writes the content of a blob to dest, with the permissions matching its Git mode (or as a
+    symlink).
+    """
+
+    data = repo.odb.stream(unhexlify(sha)).read()
+    remove_file(dest)
+    makedirs(path.dirname(dest), exist_ok=True)
+
+    if mode == MODE_SYMLINK:
+        symlink(data.decode('utf-8'), dest)
+    else:
+        with open(dest, 'wb') as f:
+            f.write(data)
+
+        chmod(dest, FILE_PERMISSIONS.get(mode, FILE_PERMISSIONS[MODE_FILE]))
+
+
+def replace_file(dest, data, mode):
+    """
+    Atomically replaces dest with the given content and Git mode: the content is written next to
+    dest and renamed over it, so that readers of dest never see a partial file.
+    """
+
+    tmp_path = path.join(path.dirname(dest), '.{}.castor-tmp'.format(path.basename(dest)))
+    remove_file(tmp_path)
+    makedirs(path.dirname(dest), exist_ok=True)
+
+    if mode == MODE_SYMLINK:
+        symlink(data.decode('utf-8'), tmp_path)
+    else:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+
+        chmod(tmp_path, FILE_PERMISSIONS.get(mode, FILE_PERMISSIONS[MODE_FILE]))
+
+    replace(tmp_path, dest)
+
+
+def remove_file(file_path):
+    """
+    Removes a file or symlink if it exists
+    """
+
+    if path.lexists(file_path) and not path.isdir(file_path) or path.islink(file_path):
+        unlink(file_path)
+
+
+def prune_empty_dirs(dir_path, stop):
+    """
+    Removes dir_path and its parents as long as they are empty, without going above stop.
+    """
+
+    stop = path.normpath(stop)
+    dir_path = path.normpath(dir_path)
+
+    while dir_path != stop and dir_path.startswith(stop + path.sep):
+        if not path.isdir(dir_path) or path.islink(dir_path) or listdir(dir_path):
+            break
+
+        rmdir(dir_path)
+        dir_path = path.dirname(dir_path)
@@ -0,0 +1,124 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+from os import path, sep
+
+
+class SkippedNode(Exception):
+    """
+    Reported by run_dag() for the nodes which did not run because their parent failed
+    """
+
+    MESSAGE = 'skipped: parent {} failed'
+
+    def __init__(self, parent):
+        super().__init__(self.MESSAGE.format(parent))
+        self.parent = parent
+
+
+def path_parts(p):
+    """
+    Splits a path into its components, ignoring trailing or duplicate separators.
+    """
+
+    return tuple(x for x in path.normpath(p).split(sep) if x)
+
+
+def nest_parents(paths, anchors):
+    """
+    For each path, finds the closest anchor that is a strict parent directory of it. Returns a
+    dictionary mapping each path to its parent anchor (or None if there is no such anchor).
+    """
+
+    anchors = {path_parts(x): x for x in anchors}
+    parents = {}
+
+    for p in paths:
+        parts = path_parts(p)
+        parents[p] = None
+
+        for i in range(len(parts) - 1, -1, -1):
+            if parts[:i] in anchors:
+                parents[p] = anchors[parts[:i]]
+                break
+
+    return parents
+
+
+def run_dag(nodes, parents, func, jobs=1):
+    """
+    Calls func(node) for each node, with up to `jobs` calls running at the same time. A node is
+    only started once its parent (as given by the `parents` dictionary) is done. Nodes are started
+    in the order they are given whenever possible.
+
+    Errors do not stop the other branches of the tree: the function returns a list of
+    (node, exception) for each failed node. Descendants of a failed node are not run at all, and
+    are reported along with a SkippedNode exception naming the node that failed.
+    """
+
+    nodes = list(nodes)
+    order = {x: i for i, x in enumerate(nodes)}
+    children = {x: [] for x in nodes}
+    ready = []
+    errors = []
+
+    for node in nodes:
+        parent = parents.get(node)
+
+        if parent is None or parent not in children:
+            ready.append(node)
+        else:
+            children[parent].append(node)
+
+    def release(node):
+        ready.extend(children[node])
+        ready.sort(key=order.get)
+
+    def fail(node, e):
+        errors.append((node, e))
+        skipped = list(children[node])
+
+        while skipped:
+            child = skipped.pop(0)
+            errors.append((child, SkippedNode(node)))
+            skipped[:0] = children[child]
+
+    if jobs <= 1:
+        while ready:
+            node = ready.pop(0)
+
+            try:
+                func(node)
+            except Exception as e:
+                fail(node, e)
+            else:
+                release(node)
+
+        return errors
+
+    # Only imported when needed, as it is slow to import
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+
+        while ready or running:
+            while ready and len(running) < jobs:
+                node = ready.pop(0)
+                running[executor.submit(func, node)] = node
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                node = running.pop(future)
+                e = future.exception()
+
+                if e is not None:
+                    fail(node, e)
+                else:
+                    release(node)
+
+    return errors
@@ -4,23 +4,55 @@
 # (c) 2015 ActivKonnect
 # Rémy Sanchez <remy.sanchez@activkonnect.com>
 
+import re
+import sys
 import json
+import time
+import hashlib
 import shlex
+import signal
 import subprocess
-from tarfile import TarFile
-from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
 from shutil import copyfile, rmtree
-import jsonschema
-import git
-
-from git.exc import GitCommandError
-from os import path, listdir, getcwd, mkdir, makedirs
+from tempfile import mkdtemp
+from functools import lru_cache
+from copy import deepcopy
+from contextlib import ExitStack
+from os import path, listdir, getcwd, mkdir, makedirs, unlink, replace, stat, killpg, walk
 from io import StringIO
 
+from .cache import CacheException, OutputCache, snapshot
+from .artifact import ArtifactException, MEMBER_BLOB, MEMBER_DISK, BlobReader, \
+    artifact_format, open_artifact, write_members, add_parents
+from .plumbing import MODE_GITLINK, MODE_FILE, MODE_EXECUTABLE, LINK_COPY, LINK_REFLINK, \
+    LINK_HARDLINK, ls_tree, diff_tree, extract_archive, link_tree, write_blob, remove_file, \
+    replace_file, prune_empty_dirs, copy_objects, hash_files, ls_index, update_index, read_head, \
+    path_digest, files_digest, list_sources, sync_files, read_gitmodules, submodule_paths, \
+    read_gitlink, worktree_status, unstaged_changes, ahead_behind, export_ignored, \
+    check_export_ignore, skipped_worktree, skip_worktree, RefIndex
+from .pool import run_dag, nest_parents, path_parts, SkippedNode
+from .filters import path_filter
+from .timing import span
+from .lazy import LazyModule
+
+git = LazyModule('git')
+jsonschema = LazyModule('jsonschema')
+
 LODGE_DIR = 'lodge'
 DAM_DIR = 'dam'
+STATE_DIR = '.castor'
+DAM_MANIFEST_NAME = 'dam.json'
+APPLY_STATE_NAME = 'state.json'
+VALIDATED_NAME = 'castorfile.valid'
+OUTPUTS_DIR = 'post_freeze'
+
+OUTPUT_LOCK = Lock()
+
+MANAGED_BEGIN = '# BEGIN Castor'
+MANAGED_END = '# END Castor'
 
 CASTORFILE_NAME = 'Castorfile'
+LOCK_NAME = 'Castorfile.lock'
 CASTORFILE_SCHEMA = {
     '$schema': 'http://json-schema.org/draft-04/schema#',
     'type': 'object',
@@ -38,6 +70,12 @@ CASTORFILE_SCHEMA = {
                 ],
             },
         },
+        'exclude': {
+            '$ref': '#/definitions/patterns',
+        },
+        'include': {
+            '$ref': '#/definitions/patterns',
+        },
     },
     'required': ['lodge'],
     'additionalProperties': False,
@@ -46,6 +84,13 @@ CASTORFILE_SCHEMA = {
             'type': 'string',
             'pattern': '^/',
         },
+        'patterns': {
+            'type': 'array',
+            'items': {
+                'type': 'string',
+                'minLength': 1,
+            },
+        },
         'git_repo': {
             'type': 'string',
             'pattern': '((\w+://)(.+@)*([\w\d\.]+)(:[\d]+){0,1}/*(.*)|'
@@ -74,6 +119,30 @@ CASTORFILE_SCHEMA = {
                         'type': 'string',
                     }
                 },
+                'post_freeze_inputs': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'string',
+                    }
+                },
+                'post_freeze_timeout': {
+                    'type': 'number',
+                    'minimum': 0,
+                    'exclusiveMinimum': True,
+                },
+                'depth': {
+                    'type': 'integer',
+                    'minimum': 1,
+                },
+                'filter': {
+                    'type': 'string',
+                },
+                'exclude': {
+                    '$ref': '#/definitions/patterns',
+                },
+                'include': {
+                    '$ref': '#/definitions/patterns',
+                },
             },
             'required': ['target', 'type', 'repo', 'version'],
             'additionalProperties': False,
@@ -117,14 +186,14 @@ class Castor(object):
     """
 
     def __init__(self, root):
-        fp = validate_repo(root)
+        castorfile = read_castorfile(root) if is_repo_root(root) else None
 
-        if fp is None:
+        if castorfile is None:
             raise CastorException('"{}" is not a valid Castor root. Does it include a Castorfile'
                                   'and is it a Git root? Is the Castorfile valid?'.format(root))
 
         self.root = path.realpath(root)
-        self.castorfile = json.load(fp)
+        self.castorfile = castorfile
 
     @property
     def castorfile_path(self):
@@ -138,6 +207,52 @@ class Castor(object):
     def dam_path(self):
         return path.join(self.root, DAM_DIR)
 
+    @property
+    def state_path(self):
+        return path.join(self.root, STATE_DIR)
+
+    def state_file(self, name):
+        """
+        Returns the path to a file of the state directory, which holds the data that Castor keeps
+        between runs and which is not versioned.
+        """
+
+        if not path.isdir(self.state_path):
+            makedirs(self.state_path, exist_ok=True)
+
+            with open(path.join(self.state_path, '.gitignore'), 'w') as f:
+                f.write('*\n')
+
+        return path.join(self.state_path, name)
+
+    def read_state(self, name):
+        """
+        Reads a JSON file from the state directory. Returns None if it does not exist or is
+        invalid.
+        """
+
+        try:
+            with open(self.state_file(name), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write_state(self, name, data):
+        """
+        Writes a JSON file to the state directory. Passing None removes it.
+        """
+
+        file_path = self.state_file(name)
+
+        if data is None:
+            if path.exists(file_path):
+                unlink(file_path)
+        else:
+            with open(file_path + '.tmp', 'w') as f:
+                json.dump(data, f, indent=4)
+
+            replace(file_path + '.tmp', file_path)
+
     @property
     def git_targets(self):
         for target in self.castorfile['lodge']:
@@ -149,10 +264,13 @@ class Castor(object):
         to_explore = list(self.git_targets)
 
         for target in to_explore:
-            for submodule in git.Repo(self.target_lodge_path(target)).submodules:
+            target_path = self.target_lodge_path(target)
+
+            for submodule_path in submodule_paths(target_path):
                 new_target = {
                     'type': 'git',
-                    'target': '/' + path.relpath(submodule.abspath, self.lodge_path),
+                    'target': '/' + path.relpath(path.join(target_path, submodule_path),
+                                                 self.lodge_path),
                 }
                 to_explore.append(new_target)
 
@@ -169,13 +287,12 @@ class Castor(object):
         """
         Validates then writes the current in-memory Castorfile to the disk.
         """
-        try:
-            jsonschema.validate(self.castorfile, CASTORFILE_SCHEMA)
-            with open(self.castorfile_path, 'w') as f:
-                json.dump(self.castorfile, f, indent=4)
-        except jsonschema.ValidationError:
+        if not castorfile_validator().is_valid(self.castorfile):
             raise CastorException('Trying to write an invalid Castorfile!')
 
+        with open(self.castorfile_path, 'w') as f:
+            json.dump(self.castorfile, f, indent=4)
+
     def abs_path(self, rel_path):
         """
         Returns an absolute path to the specified relative path
@@ -189,70 +306,403 @@ class Castor(object):
         """
         return self.abs_path(path.join(LODGE_DIR, target['target'][1:]))
 
-    def target_dam_path(self, target):
+    def target_dam_path(self, target, dam_path=None):
         """
-        Returns the absolute path of a target's dam
+        Returns the absolute path of a target's dam (or of its place in another dam_path)
         """
-        return self.abs_path(path.join(DAM_DIR, target['target'][1:]))
+        return path.join(dam_path or self.dam_path, target['target'][1:])
 
-    def exec_post_freeze(self, target, is_apply=False):
+    def exec_post_freeze(self, target, is_apply=False, timeout=None, dam_path=None):
+        """
+        Runs the post freeze commands of a target, in order. Their output is prefixed by the
+        target's name. Raises a CastorException as soon as a command fails or runs for more than
+        `timeout` seconds (the target can override it with `post_freeze_timeout`).
+        """
 
         if is_apply:
             dir_target = self.target_lodge_path(target)
         else:
-            dir_target = self.target_dam_path(target)
+            dir_target = self.target_dam_path(target, dam_path)
+
+        prefix = '[{}]'.format(target['target'])
+        timeout = target.get('post_freeze_timeout', timeout)
+
+        print_prefixed(prefix, 'Executing post freeze')
 
-        print('Executing post freeze for target {}'.format(target['target']))
+        with span('post_freeze', target['target']):
+            for cl in target['post_freeze']:
+                print_prefixed(prefix, '$ {}'.format(cl))
 
-        for cl in target['post_freeze']:
-            print(cl)
-            subprocess.Popen(shlex.split(cl), cwd=dir_target).wait()
+                with span('command', command=cl):
+                    run_command(cl, dir_target, prefix, timeout)
 
-    def apply(self, exec_post_freeze=False):
+    def exec_all_post_freeze(self, jobs=1, timeout=None, outputs=None, keys=None, dam_path=None):
+        """
+        Runs the post freeze commands of all targets in the dam. The commands of up to `jobs`
+        targets run at the same time, but a target nested in another one waits for its parent's
+        commands to be done. Errors are reported together once all commands are done.
+
+        With an OutputCache and the `keys` of the targets (see post_freeze_keys()), the result of
+        the commands is restored from the cache when possible, and stored into it otherwise.
+
+        The commands run in the dam, unless another `dam_path` is given.
+        """
+
+        targets = {self.target_dam_path(x, dam_path): x for x in self.git_targets
+                   if 'post_freeze' in x}
+        ordered = sorted(targets.keys())
+
+        def exec_target(dam_target):
+            target = targets[dam_target]
+            key = keys.get(target['target']) if outputs is not None and keys else None
+
+            if key is None:
+                self.exec_post_freeze(target, timeout=timeout, dam_path=dam_path)
+                return
+
+            with span('restore_post_freeze', target['target']):
+                restored = outputs.replay(key, dam_target)
+
+            if restored:
+                print_prefixed('[{}]'.format(target['target']), 'Restored post freeze from cache')
+            else:
+                before = snapshot(dam_target)
+                self.exec_post_freeze(target, timeout=timeout, dam_path=dam_path)
+
+                with span('store_post_freeze', target['target']):
+                    outputs.store(key, target['target'], dam_target, before)
+
+        errors = run_dag(ordered, nest_parents(ordered, ordered), exec_target, jobs)
+
+        if errors:
+            raise CastorException('Post freeze failed:\n{}'.format(
+                describe_errors(errors, lambda p: targets[p]['target'])
+            ))
+
+    def apply(self, exec_post_freeze=False, jobs=1, cache=None, depth=None, clone_filter=None,
+              force=False, locked=False, timeout=None, submodule_depth=None):
         """
         For each existing target, checkout/copy the target at the right version.
+
+        Targets are applied by up to `jobs` workers at the same time. A target is only applied
+        once the Git target it is nested in is ready, since it will be cloned or copied inside of
+        it.
+
+        If an ObjectCache is given, new clones are made from its mirrors. The `depth` and
+        `clone_filter` options make shallow/partial clones, unless the target overrides them.
+        Submodules of new clones are fetched by up to `jobs` workers too, with `submodule_depth`
+        commits of history if set.
+
+        What was applied is remembered in the state directory, and targets that did not change
+        since the last run are skipped, unless `force` is True or their post freeze commands must
+        run and did not run on this version yet.
+
+        When `locked` is True, Git targets (and their submodules) are put at the exact commits
+        recorded in the Castorfile.lock by the last freeze.
         """
 
         targets = {self.target_lodge_path(x): x for x in self.castorfile['lodge']}
 
-        git_dirs = []
-        files = []
+        git_dirs = sorted(k for k, v in targets.items() if v['type'] == 'git')
+        files = sorted(k for k, v in targets.items() if v['type'] == 'file')
+
+        lock = self.read_lock() if locked else None
+
+        if locked and lock is None:
+            raise CastorException('There is no valid {}, run "castor freeze" first'
+                                  .format(LOCK_NAME))
 
-        for target_path in sorted(targets.keys()):
+        stored = self.read_state(APPLY_STATE_NAME) or {}
+        previous = {} if force else stored
+        applied = {}
+        cloned = []
+
+        def apply_target(target_path):
             target = targets[target_path]
 
-            if target['type'] == 'git':
-                self.apply_git(target_path, target['repo'], target['version'])
-                git_dirs.append(target_path)
+            with span('apply_target', target['target']):
+                known = previous.get('targets', {}).get(target['target'])
+
+                if target['type'] == 'git':
+                    version = target['version']
+
+                    if lock is not None:
+                        version = self.locked_commit(lock, target)
+
+                    state = self.git_target_state(target['repo'], version, target_path)
+                    post_freeze = target.get('post_freeze') if exec_post_freeze else None
+
+                    # The post freeze commands that ran in the lodge are kept along the state
+                    if known is not None \
+                            and state == {k: v for k, v in known.items() if k != 'post_freeze'} \
+                            and post_freeze in (None, known.get('post_freeze')):
+                        applied[target['target']] = known
+                        return
+
+                    self.apply_git(
+                        target_path,
+                        target['repo'],
+                        version,
+                        cache,
+                        target.get('depth', depth),
+                        target.get('filter', clone_filter),
+                        jobs,
+                        submodule_depth,
+                    )
+
+                    if post_freeze is not None:
+                        self.exec_post_freeze(target, is_apply=True, timeout=timeout)
+
+                    state = self.git_target_state(target['repo'], version, target_path)
+
+                    if state is not None and post_freeze is not None:
+                        state['post_freeze'] = post_freeze
+
+                    applied[target['target']] = state
+                    cloned.append(target_path)
+
+                elif target['type'] == 'file':
+                    files = self.target_sources(target)
 
-                if 'post_freeze' in target and exec_post_freeze:
-                    self.exec_post_freeze(target, is_apply=True)
+                    if known is not None and known == self.file_target_state(target, target_path,
+                                                                             files):
+                        applied[target['target']] = known
+                        return
 
-            elif target['type'] == 'file':
-                self.apply_file(target['source'], target_path)
-                files.append(target_path)
+                    # Files copied by the previous apply but whose source is gone are removed
+                    copied = (stored.get('targets', {}).get(target['target']) or {}).get('files')
+                    self.apply_file(target['source'], target_path, copied or (), jobs, files)
+                    applied[target['target']] = self.file_target_state(target, target_path, files)
 
-        self.ignore_sub_repos(git_dirs)
-        self.ignore_files(files, git_dirs)
+        ordered = sorted(targets.keys())
+        errors = run_dag(ordered, nest_parents(ordered, git_dirs), apply_target, jobs)
+
+        if lock is not None and not errors:
+            with span('locked_submodules'):
+                self.apply_locked_submodules(lock, jobs)
+
+        excludes = sorted(x['target'] for x in targets.values())
+
+        if previous.get('excludes') != excludes or cloned:
+            with span('ignore_targets'):
+                self.ignore_targets(git_dirs, files)
+
+        self.write_state(APPLY_STATE_NAME, {
+            'targets': {k: v for k, v in applied.items() if v is not None},
+            'excludes': excludes if not errors else None,
+        })
+
+        if errors:
+            raise CastorException('Could not apply all targets:\n{}'.format(
+                describe_errors(errors, lambda p: targets[p]['target'])
+            ))
 
     @staticmethod
-    def apply_git(target_path, repo, version):
+    def git_target_state(repo, version, target_path):
+        """
+        Describes the state of a Git target in the lodge, or returns None if it is on a branch
+        (and must thus be pulled) or not cloned.
+        """
+
+        ref_name, commit = read_head(target_path)
+
+        if ref_name is not None or commit is None:
+            return None
+
+        return {
+            'repo': repo,
+            'version': version,
+            'commit': commit,
+        }
+
+    def file_target_state(self, target, target_path, files=None):
+        """
+        Describes the state of a file target: the size/mtime of each of its source files and of
+        their copies in the lodge. Returns None if a copy does not exist.
+        """
+
+        if files is None:
+            files = self.target_sources(target)
+
+        state = {}
+
+        for rel_path, file_path in files.items():
+            try:
+                source_info = stat(file_path)
+                info = stat(path.join(target_path, rel_path) if rel_path else target_path)
+            except OSError:
+                return None
+
+            state[rel_path] = [source_info.st_size, source_info.st_mtime_ns, info.st_size,
+                               info.st_mtime_ns]
+
+        return {
+            'source': target['source'],
+            'files': state,
+        }
+
+    def target_sources(self, target):
+        """
+        Lists the files copied by a file target (see list_sources())
+        """
+
+        return list_sources(self.abs_path(target['source']))
+
+    def file_target_entries(self):
+        """
+        Maps the path inside of the dam of each file copied by the file targets to its source
+        """
+
+        entries = {}
+
+        for target in self.sorted_targets(self.castorfile['lodge']):
+            if target['type'] == 'file':
+                prefix = target['target'].strip('/')
+
+                for rel_path, file_path in self.target_sources(target).items():
+                    entries[path.join(prefix, rel_path) if rel_path else prefix] = file_path
+
+        return entries
+
+    @property
+    def lock_path(self):
+        return path.join(self.root, LOCK_NAME)
+
+    def read_lock(self):
+        """
+        Returns the content of the Castorfile.lock, or None if there is no valid one.
+        """
+
+        try:
+            with open(self.lock_path, 'r') as f:
+                lock = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if isinstance(lock, dict) and isinstance(lock.get('lodge'), dict):
+            return lock
+
+    def write_lock(self, layers):
+        """
+        Writes the Castorfile.lock, which records the exact commit and tree of each Git target,
+        including the submodules.
+        """
+
+        versions = {x['target']: x for x in self.git_targets}
+        lodge = {}
+
+        for target, repo in layers:
+            commit = repo.head.commit
+            entry = {
+                'commit': commit.hexsha,
+                'tree': commit.tree.hexsha,
+            }
+
+            if target['target'] in versions:
+                entry['repo'] = versions[target['target']]['repo']
+                entry['version'] = versions[target['target']]['version']
+            else:
+                entry['submodule'] = True
+
+            lodge[target['target']] = entry
+
+        with open(self.lock_path, 'w') as f:
+            json.dump({'lodge': lodge}, f, indent=4, sort_keys=True)
+            f.write('\n')
+
+    @staticmethod
+    def locked_commit(lock, target):
+        """
+        Returns the commit a Git target is locked at, making sure that the lock matches the
+        Castorfile.
+        """
+
+        entry = lock['lodge'].get(target['target'])
+
+        if entry is None or entry.get('repo') != target['repo'] \
+                or entry.get('version') != target['version']:
+            raise CastorException('{} is out of date for target "{}", run "castor freeze" first'
+                                  .format(LOCK_NAME, target['target']))
+
+        return entry['commit']
+
+    def apply_locked_submodules(self, lock, jobs=1):
+        """
+        Puts the submodules recorded in the lock at their locked commit, in case they are not
+        where their parent repo expects them. Up to `jobs` submodules are handled at the same
+        time, nested submodules waiting for their parent.
+        """
+
+        submodules = {}
+
+        for target, entry in lock['lodge'].items():
+            target_path = self.target_lodge_path({'target': target})
+
+            if entry.get('submodule') and path.exists(target_path):
+                submodules[target_path] = (target, entry['commit'])
+
+        def checkout_submodule(target_path):
+            target, commit = submodules[target_path]
+
+            if read_head(target_path) == (None, commit):
+                return
+
+            g = git.Git(target_path)
+
+            try:
+                if RefIndex(git.Repo(target_path)).resolve(commit) is None:
+                    fetch_version(g, commit)
+
+                g.checkout(commit)
+            except git.GitCommandError:
+                raise CastorException('Could not checkout submodule "{}" at locked commit '
+                                      '"{}"'.format(target, commit))
+
+        ordered = sorted(submodules.keys())
+        errors = run_dag(ordered, nest_parents(ordered, ordered), checkout_submodule, jobs)
+
+        if errors:
+            raise CastorException('Could not checkout all locked submodules:\n{}'.format(
+                describe_errors(errors, lambda p: submodules[p][0])
+            ))
+
+    @staticmethod
+    def apply_git(target_path, repo, version, cache=None, depth=None, clone_filter=None, jobs=1,
+                  submodule_depth=None):
         """
         Put a Git target to the right version.
         :param target_path: path to checkout the Git repo
         :param repo: URL to the Git repo
         :param version: version (commit or tag) to put the repository at
+        :param cache: optional ObjectCache to clone from
+        :param depth: if set, only fetch that many commits of history
+        :param clone_filter: if set, make a partial clone using this filter (eg: blob:none)
+        :param jobs: number of submodules to fetch at the same time
+        :param submodule_depth: if set, only fetch that many commits of history of submodules
         :return:
         """
+        shallow = depth is not None or clone_filter is not None
+        _, previous_head = read_head(target_path)
+
         if not path.exists(target_path):
             makedirs(path.dirname(target_path), exist_ok=True)
             try:
-                git.Git().clone(repo, target_path)
-                repo = git.Repo(target_path)
-
-                for submodule in repo.submodules:
-                    submodule.update(recursive=True, init=True)
-            except GitCommandError:
+                with ExitStack() as stack:
+                    with span('cache', repo=repo):
+                        source = repo if cache is None else stack.enter_context(cache.ensure(repo))
+
+                    with span('clone', repo=repo):
+                        if shallow:
+                            if cache is not None:
+                                source = 'file://' + source
+
+                            clone_partial(source, target_path, version, depth, clone_filter)
+                        else:
+                            git.Git().clone(source, target_path)
+
+                        if cache is not None:
+                            git.Git(target_path).remote('set-url', 'origin', repo)
+            except (git.GitCommandError, CacheException):
                 raise CastorException('Unable to clone "{}"'.format(repo))
         elif not path.exists(path.join(target_path, '.git')):
             raise CastorException('"{}" is not a git root. Supposed to be a clone of "{}".'
@@ -260,64 +710,80 @@ class Castor(object):
 
         g = git.Git(target_path)
 
-        try:
-            g.checkout(version)
-        except GitCommandError:
-            g.fetch('origin')
+        with span('fetch', version=version):
+            if RefIndex(git.Repo(target_path)).resolve(version) is None:
+                if not fetch_version(g, version, depth, clone_filter) and not shallow:
+                    g.fetch('origin')
 
-            try:
+        try:
+            with span('checkout', version=version):
                 g.checkout(version)
-            except GitCommandError:
-                raise CastorException('Could not checkout version "{}" of "{}". Most likely because'
-                                      ' it does not exist or because your repo is dirty.'
-                                      .format(version, repo))
-
-        repo = git.Repo(target_path)
-        if not repo.head.is_detached:
-            g.pull('origin')
+        except git.GitCommandError:
+            raise CastorException('Could not checkout version "{}" of "{}". Most likely because'
+                                  ' it does not exist or because your repo is dirty.'
+                                  .format(version, repo))
+
+        head = git.Repo(target_path).head
+
+        if not head.is_detached:
+            with span('pull'):
+                if shallow:
+                    # Only the pinned branch, down to the commits that are already there
+                    if not fetch_version(g, head.reference.name, clone_filter=clone_filter):
+                        raise CastorException('Could not fetch branch "{}" of "{}"'
+                                              .format(head.reference.name, repo))
+
+                    g.merge('--ff-only', 'FETCH_HEAD')
+                else:
+                    g.pull('origin')
+
+        # Submodules follow the gitlinks of the version which was just checked out
+        if read_head(target_path)[1] != previous_head:
+            try:
+                with span('submodules'):
+                    update_submodules(target_path, jobs, submodule_depth)
+            except git.GitCommandError:
+                raise CastorException('Unable to update the submodules of "{}"'.format(repo))
 
-    def apply_file(self, source, target):
+    def apply_file(self, source, target, previous=(), jobs=1, files=None):
         """
-        Copies a file to its target
+        Copies a file, or the files of a directory or glob, to its target. Unchanged files are
+        skipped and the `previous` files which are not in the source anymore are removed (see
+        sync_files()).
         """
 
-        source_file = path.join(self.root, source)
-
-        if not path.exists(path.dirname(target)):
-            makedirs(path.dirname(target), exist_ok=True)
+        if files is None:
+            files = list_sources(path.join(self.root, source))
 
-        copyfile(source_file, target)
+        return sync_files(files, target, previous, jobs)
 
     @staticmethod
-    def ignore_sub_repos(paths):
-        """
-        Changes the git info/exclude file in order that all repos ignore each other without needing
-        to touch the .gitignore file.
-        :param paths: Paths of all the Git repos
+    def ignore_targets(repos, files):
         """
+        Changes the git info/exclude file in order that all repos ignore the repos and files nested
+        inside of them without needing to touch the .gitignore file.
 
-        for repo in paths:
-            for sub in (x for x in paths if x.startswith(repo) and x != repo):
-                ignore_path = '/' + path.relpath(sub, repo)
-                ensure_line_in_file(path.join(repo, '.git', 'info', 'exclude'), ignore_path)
+        Each path is only excluded from the closest repo that contains it. The lines are kept in a
+        block managed by Castor, which is entirely rewritten so that lines of targets which do not
+        exist anymore are removed.
 
-    @staticmethod
-    def ignore_files(files, repos):
-        """
-        Ignore the given list of files from within the given list of repos. Same as ignore_sub_repos
-        but for files, basically.
+        :param repos: Paths of all the Git repos
+        :param files: Paths of all the file targets
         """
 
-        for repo in repos:
-            ignore_file = path.join(repo, '.git', 'info', 'exclude')
-            for file in (x for x in files if x.startswith(repo)):
-                ignore_path = '/' + path.relpath(file, repo)
-                ensure_line_in_file(ignore_file, '{}'.format(ignore_path))
+        excludes = {x: [] for x in repos}
+
+        for sub, repo in sorted(nest_parents(list(repos) + list(files), repos).items()):
+            if repo is not None:
+                excludes[repo].append('/' + path.relpath(sub, repo))
 
-    def update_versions(self):
+        for repo, lines in excludes.items():
+            write_managed_lines(path.join(repo, '.git', 'info', 'exclude'), lines)
+
+    def update_versions(self, targets=None):
         """
         Look at the current version of the targets, and update the in-memory Castorfile
-        accordingly.
+        accordingly. If `targets` is given, only the targets whose path is in it are looked at.
 
         This will return True if a change was detected.
         """
@@ -325,94 +791,985 @@ class Castor(object):
         changed = False
 
         for target in self.git_targets:
+            if targets is not None and target['target'] not in targets:
+                continue
+
             repo = git.Repo(self.target_lodge_path(target))
             commit = repo.head.commit.hexsha
 
             if commit != target['version']:
-                found = False
-                tag = commit
+                # Built on each call, tags may have been created since the previous one
+                refs = RefIndex(repo)
 
-                for ref in repo.refs:
-                    if ref.commit.hexsha == commit:
-                        if isinstance(ref, git.TagReference):
-                            tag = ref.name
-
-                        if ref.name == target['version']:
-                            found = True
-                            break
-
-                if not found:
-                    target['version'] = tag
+                if target['version'] not in refs.names(commit):
+                    tags = refs.tags(commit)
+                    target['version'] = tags[-1] if tags else commit
                     changed = True
 
         return changed
 
-    def gather_dam(self):
+    def filter_settings(self):
+        """
+        The exclude/include patterns of the Castorfile and of each Git target, which decide what
+        goes into the dam
+        """
+
+        return {
+            'exclude': self.castorfile.get('exclude', []),
+            'include': self.castorfile.get('include', []),
+            'targets': {t['target']: [t.get('exclude', []), t.get('include', [])]
+                        for t in self.git_targets if 'exclude' in t or 'include' in t},
+        }
+
+    def layer_filter(self, target):
+        """
+        Returns a function telling if a file of a layer, given relative to the layer, goes into
+        the dam. The .gitignore files never do, and neither do the files excluded by the patterns
+        of the Castorfile (matched relative to the dam) or of the Git target the layer belongs to
+        (matched relative to that target, which contains the layer when it is a submodule). See
+        castor.filters for the syntax of the patterns.
+        """
+
+        configured = {x['target']: x for x in self.git_targets}
+        owner = configured.get(target['target'])
+
+        if owner is None:
+            owner = configured.get(nest_parents([target['target']], configured)[target['target']])
+
+        global_filter = path_filter(tuple(self.castorfile.get('exclude', [])),
+                                    tuple(self.castorfile.get('include', [])))
+        target_filter = path_filter(tuple(owner.get('exclude', [])),
+                                    tuple(owner.get('include', []))) if owner else None
+
+        layer_parts = path_parts(target['target'])
+        dam_dir = '/'.join(layer_parts)
+        owner_dir = '/'.join(layer_parts[len(path_parts(owner['target'])):]) if owner else ''
+
+        def accept(file_path):
+            if path.basename(file_path) == '.gitignore':
+                return False
+            elif global_filter and not global_filter.accept(path.join(dam_dir, file_path)):
+                return False
+            elif target_filter and not target_filter.accept(path.join(owner_dir, file_path)):
+                return False
+
+            return True
+
+        return accept
+
+    def dam_layers(self):
+        """
+        Returns the (target, repo) layers which make up the dam, in the order they have to be
+        applied.
+        """
+
+        return [(x, git.Repo(self.target_lodge_path(x))) for x in self.git_targets_with_submodules]
+
+    def dam_manifest(self, layers, post_freeze_keys=None):
+        """
+        Describes what the dam is built from: the commit of each layer, as well as the file targets
+        and post freeze commands (and the keys of their results, if known).
+        """
+
+        manifest = {
+            'layers': {t['target']: r.head.commit.hexsha for t, r in layers},
+            'files': {t['target']: [t['source'], sorted(self.target_sources(t))]
+                      for t in self.castorfile['lodge'] if t['type'] == 'file'},
+            'post_freeze': {t['target']: t['post_freeze'] for t in self.git_targets
+                            if 'post_freeze' in t},
+            'filters': self.filter_settings(),
+        }
+
+        if post_freeze_keys is not None:
+            manifest['post_freeze_keys'] = post_freeze_keys
+
+        return manifest
+
+    def output_cache(self):
+        """
+        Returns the cache of post freeze results, which lives in the state directory.
+        """
+
+        return OutputCache(self.state_file(OUTPUTS_DIR))
+
+    def post_freeze_keys(self, layers):
+        """
+        Computes, for each target with post freeze commands, a key identifying everything those
+        commands can depend on: the trees of the layers and the content of the file targets found
+        below the target, its declared `post_freeze_inputs` (relative to the Castor root), the
+        commands themselves and the key of the post freeze target it is nested in.
+        """
+
+        targets = [x for x in self.sorted_targets(self.git_targets) if 'post_freeze' in x]
+        names = [x['target'] for x in targets]
+        parents = nest_parents(names, names)
+        keys = {}
+
+        def below(a, b):
+            return a[:len(b)] == b
+
+        for target in targets:
+            parts = path_parts(target['target'])
+            data = {
+                'commands': target['post_freeze'],
+                'filters': self.filter_settings(),
+                'parent': keys.get(parents[target['target']]),
+                'layers': {},
+                'files': {},
+                'inputs': {},
+            }
+
+            for layer, repo in layers:
+                layer_parts = path_parts(layer['target'])
+
+                if below(layer_parts, parts):
+                    data['layers'][layer['target']] = repo.head.commit.tree.hexsha
+                elif below(parts, layer_parts):
+                    try:
+                        data['layers'][layer['target']] = repo.git.rev_parse(
+                            '--verify', '--quiet',
+                            'HEAD:{}'.format('/'.join(parts[len(layer_parts):]))
+                        )
+                    except git.GitCommandError:
+                        data['layers'][layer['target']] = None
+
+            for x in self.castorfile['lodge']:
+                if x['type'] == 'file' and below(path_parts(x['target']), parts):
+                    data['files'][x['target']] = files_digest(self.target_sources(x))
+
+            for x in target.get('post_freeze_inputs', []):
+                data['inputs'][x] = path_digest(self.abs_path(x))
+
+            keys[target['target']] = hashlib.sha1(
+                json.dumps(data, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+
+        return keys
+
+    def read_dam_manifest(self):
+        """
+        Returns the manifest of the current dam, or None if there is no valid one.
+        """
+
+        return self.read_state(DAM_MANIFEST_NAME)
+
+    def write_dam_manifest(self, manifest):
+        """
+        Writes the manifest of the current dam. Passing None removes it.
+        """
+
+        self.write_state(DAM_MANIFEST_NAME, manifest)
+
+    def dam_index_tree(self):
+        """
+        Returns the SHA of the dam's tree in the Castor repo's index, if any.
+        """
+
+        try:
+            return git.Repo(self.root).git.write_tree('--prefix={}/'.format(DAM_DIR))
+        except git.GitCommandError:
+            return None
+
+    def gather_dam(self, jobs=1, link=LINK_COPY, timeout=None, post_freeze_cache=True):
         """
         Replaces the current dam (if it exists) with a copy if the lodge's current version (but NOT
         the current state of lodge on the disk, instead it checks out the HEAD of all git repos).
+
+        When the dam was built by a previous run from the same targets, only the files that
+        changed between the previous and the current commit of each target are updated. Otherwise,
+        the targets are extracted by up to `jobs` workers, using the `link` method.
+
+        Post freeze commands are then run by up to `jobs` workers too, with the given `timeout`.
+        With `post_freeze_cache`, their results are cached (see OutputCache): the dam is only
+        updated in place if none of the inputs of the commands changed, in which case their
+        previous results are kept as is, and it is otherwise rebuilt so that the cache always
+        records what the commands do to a pristine target. Without it, a dam with post freeze
+        commands is always rebuilt, since the commands must run on a pristine target again.
+        """
+
+        # Left by gather_dam_tree(), the files of the dam are on the disk again from now on
+        with span('dam_worktree'):
+            root = git.Repo(self.root)
+            skip_worktree(root, skipped_worktree(root, DAM_DIR), False)
+
+        with span('dam_layers'):
+            layers = self.dam_layers()
+
+        with span('dam_manifest'):
+            outputs = self.output_cache() if post_freeze_cache else None
+            keys = self.post_freeze_keys(layers) if post_freeze_cache else None
+            manifest = self.dam_manifest(layers, keys)
+            previous = self.read_dam_manifest()
+            self.write_dam_manifest(None)
+
+        with span('update_dam'):
+            updated = self.update_dam(previous, manifest, layers)
+
+        if not updated:
+            with span('rebuild_dam'):
+                manifest['hardlinked'] = self.rebuild_dam(layers, jobs, link)
+        else:
+            manifest['hardlinked'] = previous.get('hardlinked')
+
+        # Files below post freeze targets are part of their keys, the cached results are kept
+        kept = [path_parts(x) for x in manifest['post_freeze']] if updated else []
+
+        with span('files'):
+            for target in self.sorted_targets(self.castorfile['lodge']):
+                parts = path_parts(target['target'])
+
+                if target['type'] == 'file' and not any(parts[:len(x)] == x for x in kept):
+                    self.apply_file(target['source'], self.target_dam_path(target), jobs=jobs)
+
+        if not updated:
+            with span('post_freeze_all'):
+                self.exec_all_post_freeze(jobs, timeout, outputs, keys)
+
+        self.write_dam_manifest(manifest)
+
+    def rebuild_dam(self, layers, jobs=1, link=LINK_COPY):
+        """
+        Builds the Git part of the dam from scratch. Up to `jobs` layers are extracted at the same
+        time, but nested layers wait for their parent in order to overwrite its files.
+
+        With a `link` method other than copy, layers whose lodge is clean share their files with
+        the lodge through reflinks or hardlinks (see link_tree()).
+
+        Returns the sorted list of the targets whose files were hardlinked.
         """
 
         if path.exists(self.dam_path):
             rmtree(self.dam_path)
 
-        for target in self.git_targets_with_submodules:
-            repo = git.Repo(self.target_lodge_path(target))
-            dam_target = self.target_dam_path(target)
+        filters = {self.target_dam_path(t): self.layer_filter(t) for t, _ in layers}
+        names = {self.target_dam_path(t): t['target'] for t, _ in layers}
+        layers = {self.target_dam_path(t): r for t, r in layers}
+        hardlinked = []
+
+        # post_freeze commands could write through hardlinks into the lodge
+        safe_links = {}
+
+        if link == LINK_HARDLINK:
+            for target in self.git_targets:
+                if 'post_freeze' in target:
+                    post_path = path_parts(self.target_dam_path(target))
+                    safe_links.update({x: LINK_REFLINK for x in layers
+                                       if path_parts(x)[:len(post_path)] == post_path})
+
+        def extract_layer(dam_target):
             makedirs(dam_target, exist_ok=True)
+            method = safe_links.get(dam_target, link)
 
-            with NamedTemporaryFile('wb') as f:
-                repo.archive(f, format='tar')
+            with span('extract', path.normpath('/' + path.relpath(dam_target, self.dam_path)),
+                      method=method):
+                if method == LINK_COPY or not link_tree(layers[dam_target], dam_target, method,
+                                                        filters[dam_target]):
+                    extract_archive(layers[dam_target], dam_target, accept=filters[dam_target])
+                elif method == LINK_HARDLINK:
+                    hardlinked.append(names[dam_target])
 
-                with TarFile(f.name, 'r') as t:
-                    t.extractall(dam_target, members=(x for x in t.getmembers()
-                                                      if path.basename(x.name) != '.gitignore'))
+        ordered = sorted(layers.keys())
+        errors = run_dag(ordered, nest_parents(ordered, ordered), extract_layer, jobs)
 
-        for target in self.sorted_targets(self.castorfile['lodge']):
-            if target['type'] == 'file':
-                self.apply_file(target['source'], self.target_dam_path(target))
+        if errors:
+            raise CastorException('Could not gather all targets:\n{}'.format(
+                describe_errors(errors, lambda p: '/' + path.relpath(p, self.dam_path))
+            ))
 
-        for target in self.git_targets:
-            if 'post_freeze' in target:
-                self.exec_post_freeze(target)
+        return sorted(hardlinked)
 
-    def freeze(self):
+    def update_dam(self, previous, manifest, layers):
+        """
+        Updates the Git part of the dam from the previous manifest to the new one, by applying
+        the diff of each layer. Returns False if this is not possible and that the dam must be
+        rebuilt instead.
+        """
+
+        if previous is None or not path.isdir(self.dam_path):
+            return False
+
+        # Without their keys, the results of the post freeze commands cannot be kept
+        if manifest['post_freeze'] and 'post_freeze_keys' not in manifest:
+            return False
+
+        if any(previous.get(k) != manifest.get(k) for k in ('files', 'filters', 'post_freeze',
+                                                            'post_freeze_keys')) \
+                or set(previous.get('layers', {})) != set(manifest['layers']):
+            return False
+
+        if 'index_tree' in previous:
+            if previous['index_tree'] != self.dam_index_tree():
+                return False
+
+            # Files of the dam that were edited by hand since it was staged
+            try:
+                if unstaged_changes(self.root, DAM_DIR):
+                    return False
+            except git.GitCommandError:
+                return False
+
+        # Hardlinked files are shared with the lodge, so editing the lodge edits the dam too
+        hardlinked = set(previous.get('hardlinked') or ())
+
+        for target, repo in layers:
+            if target['target'] in hardlinked \
+                    and repo.is_dirty(index=True, working_tree=True, untracked_files=False):
+                return False
+
+        changes = []
+
+        try:
+            for i, (target, repo) in enumerate(layers):
+                old = previous['layers'][target['target']]
+                new = manifest['layers'][target['target']]
+
+                if old != new:
+                    changes.extend((i, x) for x in diff_tree(repo, old, new))
+        except git.GitCommandError:
+            return False
+
+        # Changed attributes could export-ignore files that are not part of the diff
+        if any(path.basename(x[1][5]) == '.gitattributes' for x in changes):
+            return False
+
+        trees = {}
+        accepts = {}
+
+        def layer_prefix(j):
+            return layers[j][0]['target'].rstrip('/') + '/'
+
+        def layer_tree(j):
+            if j not in trees:
+                trees[j] = ls_tree(layers[j][1], manifest['layers'][layers[j][0]['target']])
+
+            return trees[j]
+
+        # Only the paths the changes can touch are checked for export-ignore, in each layer
+        # covering them, so that the cost follows the size of the change rather than of the tree
+        checked = {}
+
+        for i, (_, _, _, _, _, rel) in changes:
+            full = layer_prefix(i) + rel
+
+            for j in range(len(layers)):
+                if full.startswith(layer_prefix(j)):
+                    checked.setdefault(j, set()).add(full[len(layer_prefix(j)):])
+
+        def layer_accept(j, rel):
+            if j not in accepts:
+                accepts[j] = (self.layer_filter(layers[j][0]),
+                              check_export_ignore(layers[j][1], checked.get(j, ())))
+
+            return accepts[j][0](rel) and rel not in accepts[j][1]
+
+        def layer_file(j, rel):
+            entry = layer_tree(j).get(rel)
+
+            if entry is not None and entry[0] != MODE_GITLINK and layer_accept(j, rel):
+                return entry
+
+        to_delete = []
+        to_write = []
+
+        for i, (old_mode, new_mode, old_sha, new_sha, status, rel) in changes:
+            if not layer_accept(i, rel):
+                continue
+
+            full = layer_prefix(i) + rel
+            owner = None
+
+            for j in range(len(layers) - 1, -1, -1):
+                if not full.startswith(layer_prefix(j)):
+                    continue
+                elif j == i:
+                    if status != 'D' and new_mode != MODE_GITLINK:
+                        owner = (j, new_mode, new_sha)
+                else:
+                    entry = layer_file(j, full[len(layer_prefix(j)):])
+
+                    if entry is not None:
+                        owner = (j, ) + entry
+
+                if owner is not None:
+                    break
+
+            dest = path.join(self.dam_path, full[1:])
+
+            if owner is None:
+                to_delete.append(dest)
+            elif owner[0] <= i:
+                to_write.append((layers[owner[0]][1], owner[2], owner[1], dest))
+
+        for dest in to_delete:
+            remove_file(dest)
+            prune_empty_dirs(path.dirname(dest), self.dam_path)
+
+        for repo, sha, mode, dest in to_write:
+            write_blob(repo, sha, mode, dest)
+
+        return True
+
+    def dam_entries(self, layers):
+        """
+        Computes the Git part of the dam from the trees of its layers, without touching the disk.
+        Returns a dictionary mapping each path of the dam to a (mode, sha, repo) tuple, repo being
+        the layer the object comes from.
+        """
+
+        entries = {}
+
+        for target, repo in layers:
+            prefix = target['target'].strip('/')
+            accept = self.layer_filter(target)
+            files = ls_tree(repo, 'HEAD')
+            ignored = export_ignored(repo, files)
+
+            for file_path, (mode, sha) in files.items():
+                if mode != MODE_GITLINK and accept(file_path) and file_path not in ignored:
+                    entries[path.join(prefix, file_path)] = (mode, sha, repo)
+
+        return entries
+
+    def gather_dam_tree(self, checkout=False, jobs=1, timeout=None, post_freeze_cache=True):
+        """
+        Builds the dam directly into the index of the Castor repo: the objects of each layer are
+        copied into its database, file targets are hashed as blobs and the dam entries of the
+        index are replaced by the result.
+
+        The dam is only written on the disk if `checkout` is True. Otherwise, only the targets
+        that have post freeze commands are checked out, so that the commands can run (or their
+        cached results can be restored, with `post_freeze_cache`), and their results are added
+        back to the index. The rest of a dam previously written on the disk is removed, and the
+        entries of the index which are not checked out are marked skip-worktree, so that Git does
+        not see them as deleted.
+        """
+
+        root = git.Repo(self.root)
+
+        with span('dam_worktree'):
+            skip_worktree(root, skipped_worktree(root, DAM_DIR), False)
+
+        with span('dam_layers'):
+            layers = self.dam_layers()
+            entries = self.dam_entries(layers)
+
+        by_repo = {}
+
+        for mode, sha, repo in entries.values():
+            by_repo.setdefault(repo, []).append(sha)
+
+        with span('copy_objects'):
+            for repo, shas in by_repo.items():
+                copy_objects(repo, root, shas)
+
+        with span('files'):
+            files = sorted(self.file_target_entries().items())
+            sources = [x for _, x in files]
+
+            for (name, source), sha in zip(files, hash_files(root, sources)):
+                mode = MODE_EXECUTABLE if stat(source).st_mode & 0o100 else MODE_FILE
+                entries[name] = (mode, sha, None)
+
+        with span('update_index'):
+            update_index(root, DAM_DIR, {k: v[:2] for k, v in entries.items()})
+
+        post_freeze = [x for x in self.git_targets if 'post_freeze' in x]
+
+        if checkout:
+            to_checkout = [self.dam_path]
+        else:
+            to_checkout = [self.target_dam_path(x) for x in post_freeze]
+
+        with span('checkout'):
+            if not checkout and path.exists(self.dam_path):
+                rmtree(self.dam_path)
+
+            for dam_target in to_checkout:
+                if path.exists(dam_target):
+                    rmtree(dam_target)
+
+                if entries:
+                    root.git.checkout('--', path.relpath(dam_target, self.root))
+
+        with span('post_freeze_all'):
+            keys = self.post_freeze_keys(layers) if post_freeze_cache else None
+            self.exec_all_post_freeze(jobs, timeout, self.output_cache() if keys else None, keys)
+
+        if post_freeze:
+            with span('stage_post_freeze'):
+                root.git.add('--all', '--', *[path.relpath(self.target_dam_path(x), self.root)
+                                              for x in post_freeze])
+
+        if not checkout:
+            checked_out = [path_parts(x['target']) for x in post_freeze]
+
+            with span('dam_worktree'):
+                skip_worktree(root, [
+                    '{}/{}'.format(DAM_DIR, x) for x in ls_index(root, DAM_DIR)
+                    if not any(path_parts(x)[:len(p)] == p for p in checked_out)
+                ])
+
+        self.write_dam_manifest(self.dam_manifest(layers, keys) if checkout else None)
+
+    def export(self, out_path, jobs=1, timeout=None, post_freeze_cache=True):
+        """
+        Writes what the dam would contain into a tarball at out_path, without writing the dam on
+        the disk. Files are streamed from the Git objects of the layers, in their overlay order,
+        and from the file targets. Only targets with post freeze commands are written to a
+        temporary directory, so that the commands can run (or their cached results be restored).
+
+        Members are sorted and their modification times and owners are normalized, so that the
+        same inputs always produce the same artifact (see castor.artifact).
+        """
+
+        try:
+            artifact_format(out_path)
+        except ArtifactException as e:
+            raise CastorException(e)
+
+        with span('dam_layers'):
+            layers = self.dam_layers()
+            members = {k: (MEMBER_BLOB, ) + v for k, v in self.dam_entries(layers).items()}
+
+        for name, file_path in self.file_target_entries().items():
+            members[name] = (MEMBER_DISK, file_path)
+
+        post_freeze = [x for x in self.sorted_targets(self.git_targets) if 'post_freeze' in x]
+        prefixes = [x['target'].strip('/') for x in post_freeze]
+        roots = [p for p in prefixes
+                 if not any(p != q and (not q or p.startswith(q + '/')) for q in prefixes)]
+
+        def under_root(name):
+            return any(not r or name == r or name.startswith(r + '/') for r in roots)
+
+        tmp_dam = mkdtemp(prefix='castor-export-')
+
+        try:
+            if post_freeze:
+                with span('checkout'):
+                    for name in [x for x in members if under_root(x)]:
+                        dest = path.join(tmp_dam, name)
+                        member = members.pop(name)
+
+                        if member[0] == MEMBER_BLOB:
+                            write_blob(member[3], member[2], member[1], dest)
+                        else:
+                            makedirs(path.dirname(dest), exist_ok=True)
+                            copyfile(member[1], dest)
+
+                    for target in post_freeze:
+                        makedirs(self.target_dam_path(target, tmp_dam), exist_ok=True)
+
+                with span('post_freeze_all'):
+                    keys = self.post_freeze_keys(layers) if post_freeze_cache else None
+                    self.exec_all_post_freeze(jobs, timeout,
+                                              self.output_cache() if keys else None, keys,
+                                              tmp_dam)
+
+                for r in roots:
+                    root_path = path.join(tmp_dam, r)
+
+                    for dir_path, dir_names, file_names in walk(root_path):
+                        for name in dir_names + file_names:
+                            full = path.join(dir_path, name)
+                            members[path.relpath(full, tmp_dam)] = (MEMBER_DISK, full)
+
+            add_parents(members)
+
+            with span('write_artifact'):
+                with open_artifact(out_path) as tar:
+                    write_members(tar, members)
+        except ArtifactException as e:
+            raise CastorException(e)
+        finally:
+            rmtree(tmp_dam)
+
+    def freeze(self, jobs=1, link=LINK_COPY, tree=False, checkout=False, timeout=None,
+               post_freeze_cache=True, artifact=None, targets=None):
         """
         The goal is to update current versions to the current Git HEADs, and gather all the files
         in the dam directory.
         If any change is detected, the Castorfile will be written on disk and the changes will be
         added to the Git index.
-        """
 
-        def path_in_dam(to_test):
-            return path.join(self.root, to_test).startswith(path.join(self.dam_path, ''))
+        With `tree`, the dam is built directly in the index from Git objects instead (see
+        gather_dam_tree()). With `post_freeze_cache`, the results of post freeze commands are
+        restored from the cache when their inputs did not change.
+
+        With an `artifact` path, the dam is not touched at all: its content is written into that
+        tarball instead (see export()). With `targets`, only the versions of those targets are
+        updated (see update_versions()).
+        """
 
-        changed = self.update_versions()
+        with span('update_versions'):
+            changed = self.update_versions(targets)
 
         if changed or True:
-            self.gather_dam()
-            self.write_castorfile()
+            if artifact is not None:
+                with span('export'):
+                    self.export(artifact, jobs, timeout, post_freeze_cache)
+            elif tree:
+                with span('gather_dam_tree'):
+                    self.gather_dam_tree(checkout, jobs, timeout, post_freeze_cache)
+            else:
+                with span('gather_dam'):
+                    self.gather_dam(jobs, link, timeout, post_freeze_cache)
+
+            with span('write_castorfile'):
+                self.write_castorfile()
+                self.write_lock(self.dam_layers())
 
             repo = git.Repo(self.root)
-            staged = {CASTORFILE_NAME}
+            staged = [CASTORFILE_NAME, LOCK_NAME]
+
+            if not tree and artifact is None \
+                    and (path.exists(self.dam_path) or repo.git.ls_files('--', DAM_DIR)):
+                staged.append(DAM_DIR)
+
+            # A single process stages all additions, modifications and deletions of the dam
+            with span('stage'):
+                repo.git.add('--all', '--', *staged)
+
+            if artifact is not None:
+                return
+
+            manifest = self.read_dam_manifest()
+
+            if manifest is not None:
+                manifest['index_tree'] = self.dam_index_tree()
+                self.write_dam_manifest(manifest)
+
+    def castorfile_signature(self):
+        """
+        Returns the metadata of the Castorfile which changes when it is written, or None if it
+        does not exist.
+        """
+
+        try:
+            st = stat(self.castorfile_path)
+        except OSError:
+            return None
+
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def watch_state(self):
+        """
+        Returns what the watch mode looks at, read without spawning any process: the metadata of
+        the Castorfile, the HEAD of each layer and the metadata of the source of each file target.
+        """
+
+        state = {CASTORFILE_NAME: self.castorfile_signature()}
+
+        for target in self.git_targets_with_submodules:
+            state[target['target']] = read_head(self.target_lodge_path(target))
+
+        for target in self.castorfile['lodge']:
+            if target['type'] == 'file':
+                files = []
+
+                for rel_path, file_path in sorted(self.target_sources(target).items()):
+                    try:
+                        st = stat(file_path)
+                        files.append((rel_path, st.st_mtime_ns, st.st_size, st.st_ino))
+                    except OSError:
+                        files.append((rel_path, None))
+
+                state[target['target']] = files
+
+        return state
+
+    def refresh_watched(self, previous, current, jobs=1, link=LINK_COPY, timeout=None,
+                        post_freeze_cache=True):
+        """
+        Freezes the changes between two states returned by watch_state(). Only the versions of
+        the targets that moved are updated, and the dam only gets the diff of each of them.
+
+        The Castorfile is read again first, so that the freeze does not overwrite the edits made
+        to it. When it was edited, all the targets are frozen.
+
+        Returns the targets that moved.
+        """
+
+        moved = sorted(x for x in set(previous) | set(current)
+                       if previous.get(x) != current.get(x))
+
+        if moved:
+            castorfile = read_castorfile(self.root)
+
+            if castorfile is None:
+                raise CastorException('The Castorfile is not valid, fix it to resume the watch')
+
+            self.castorfile = castorfile
+            targets = None if CASTORFILE_NAME in moved else moved
+
+            self.freeze(jobs, link, timeout=timeout, post_freeze_cache=post_freeze_cache,
+                        targets=targets)
+
+        return moved
+
+    def watch(self, jobs=1, link=LINK_COPY, timeout=None, post_freeze_cache=True, interval=0.5,
+              delay=0.5):
+        """
+        Keeps the dam up to date while working in the lodge. The state of the targets (see
+        watch_state()) is polled every `interval` seconds and, once a change was detected and
+        nothing else changed for `delay` seconds, it is frozen (see refresh_watched()).
+
+        Errors are reported without stopping, the watch runs until it is interrupted. Edits of
+        the Castorfile are picked up like the other changes.
+        """
+
+        state = self.watch_state()
+        print('Watching {} targets'.format(len(state) - 1))
+
+        while True:
+            time.sleep(interval)
+            current = self.watch_state()
+
+            if current == state:
+                continue
+
+            # Commits, checkouts and rebases move refs several times, wait for them to settle
+            while True:
+                time.sleep(delay)
+                settled = self.watch_state()
+
+                if settled == current:
+                    break
+
+                current = settled
+
+            start = time.monotonic()
+
+            try:
+                moved = self.refresh_watched(state, current, jobs, link, timeout,
+                                             post_freeze_cache)
+            except (CastorException, git.GitCommandError, OSError) as e:
+                sys.stderr.write('Error: {}\n'.format(e))
+            else:
+                print('Refreshed {} in {:.2f}s'.format(', '.join(moved),
+                                                       time.monotonic() - start))
+
+            # The freeze itself writes the Castorfile, which must not trigger another one
+            state = dict(current)
+            state[CASTORFILE_NAME] = self.castorfile_signature()
+
+    def status(self, jobs=8):
+        """
+        Describes how each Git target, and each submodule, drifted from what the Castorfile pins:
+        where its HEAD is compared to its pinned commit, if it has uncommitted changes or untracked
+        files, or if it is not cloned at all. Targets are looked at by up to `jobs` workers.
+
+        The HEAD is read from the files of each repo and the pinned commit comes from the
+        Castorfile.lock when it matches the Castorfile, so a target that did not move only costs a
+        single "git status". Submodules are pinned by the gitlink found in the HEAD of their
+        parent.
+
+        Returns a list of dictionaries, sorted by target.
+        """
+
+        lock = self.read_lock() or {'lodge': {}}
+        versions = {x['target']: x for x in self.git_targets}
+        targets = {x['target']: x for x in self.git_targets_with_submodules}
+
+        # Submodules that were never checked out are not found by git_targets_with_submodules
+        for target in list(targets.values()):
+            target_path = self.target_lodge_path(target)
+            checked_out = set(submodule_paths(target_path))
+
+            for module in read_gitmodules(target_path).values():
+                sub = module.get('path', '').strip('/')
+
+                if sub and sub not in checked_out:
+                    name = '/' + path.relpath(path.join(target_path, sub), self.lodge_path)
+                    targets[name] = {'type': 'git', 'target': name}
+
+        ordered = sorted(targets)
+        parents = nest_parents(ordered, ordered)
+        results = {}
+
+        def target_status(name):
+            configured = versions.get(name)
+            entry = lock['lodge'].get(name) or {}
+            target_path = self.target_lodge_path(targets[name])
+            parent_path = self.target_lodge_path(targets[parents[name]]) if parents[name] else None
+            out = results[name] = {
+                'target': name,
+                'submodule': configured is None,
+                'version': configured['version'] if configured else None,
+                'pinned': None,
+                'head': None,
+                'branch': None,
+                'missing': False,
+                'dirty': False,
+                'untracked': False,
+                'ahead': None,
+                'behind': None,
+            }
+
+            with span('target_status', name):
+                ref_name, out['head'] = read_head(target_path)
+
+                if out['head'] is None:
+                    out['missing'] = True
+                    return
+
+                if ref_name is not None:
+                    out['branch'] = RefIndex.short_name(ref_name)
+
+                if configured is None:
+                    if parent_path is not None and read_head(parent_path)[1] is not None:
+                        out['pinned'] = read_gitlink(parent_path,
+                                                     path.relpath(target_path, parent_path))
+                elif entry.get('repo') == configured['repo'] \
+                        and entry.get('version') == configured['version']:
+                    out['pinned'] = entry.get('commit')
+                elif re.match(r'^[0-9a-f]{40}$', configured['version']):
+                    out['pinned'] = configured['version']
+                else:
+                    out['pinned'] = RefIndex(git.Repo(target_path)).resolve(configured['version'])
+
+                out['dirty'], out['untracked'] = worktree_status(target_path)
+
+                if out['pinned'] == out['head']:
+                    out['ahead'], out['behind'] = 0, 0
+                elif out['pinned'] is not None:
+                    out['ahead'], out['behind'] = \
+                        ahead_behind(target_path, out['pinned'], out['head']) or (None, None)
+
+        for name, e in run_dag(ordered, {}, target_status, jobs):
+            results[name]['error'] = str(e)
+
+        return [results[x] for x in ordered]
+
+    @staticmethod
+    def deploy_state_name(dest):
+        return 'deploy-{}.json'.format(hashlib.sha1(dest.encode('utf-8')).hexdigest())
+
+    def deploy(self, dest, full=False, dry_run=False):
+        """
+        Copies the frozen dam, as found in the index of the Castor repo, into dest. The (mode, SHA)
+        of each file deployed to dest is kept in the state directory, so that the next deployment
+        only writes the files that were added or changed and removes the files that are gone.
+
+        Each file is written next to its destination and renamed over it, so that a file being
+        served from dest is never seen half written. With `full`, all the files are written again.
+        With `dry_run`, the changes are only listed.
+
+        Returns the lists of added, changed and removed paths.
+        """
+
+        dest = path.realpath(dest)
+        repo = git.Repo(self.root)
+        state_name = self.deploy_state_name(dest)
+
+        with span('dam_index'):
+            current = ls_index(repo, DAM_DIR)
+
+        if not current:
+            raise CastorException('The dam is empty, run "castor freeze" first')
+
+        previous = self.read_state(state_name) if path.isdir(dest) else None
+        known = {k: tuple(v) for k, v in previous['files'].items()} if previous else {}
+
+        added = sorted(x for x in current if x not in known)
+        changed = sorted(x for x in current if x in known and (full or known[x] != current[x]))
+        removed = sorted(x for x in known if x not in current)
+
+        if dry_run:
+            for prefix, names in (('+', added), ('~', changed), ('-', removed)):
+                for name in names:
+                    print('{} {}'.format(prefix, name))
+        else:
+            with span('remove'):
+                for name in removed:
+                    remove_file(path.join(dest, name))
+                    prune_empty_dirs(path.dirname(path.join(dest, name)), dest)
+
+            reader = BlobReader(repo)
+
+            try:
+                with span('write'):
+                    for name in sorted(added + changed):
+                        mode, sha = current[name]
+                        file_path = path.join(dest, name)
+
+                        if path.isdir(file_path) and not path.islink(file_path):
+                            raise CastorException('Cannot deploy {}, a directory is in the way'
+                                                  .format(file_path))
+
+                        replace_file(file_path, reader.read(sha), mode)
+            except (OSError, ArtifactException) as e:
+                raise CastorException('Could not deploy to {}: {}'.format(dest, e))
+            finally:
+                reader.close()
 
-            for diff in repo.index.diff(None):
-                is_interesting = ((diff.b_path is not None and path_in_dam(diff.b_path)) or
-                                  (diff.a_path is not None and path_in_dam(diff.a_path)))
+            self.write_state(state_name, {
+                'dest': dest,
+                'files': current,
+            })
 
-                if is_interesting:
-                    if diff.a_path is not None:
-                        staged.add(diff.a_path)
+        print('{} added, {} changed, {} removed'.format(len(added), len(changed), len(removed)))
 
-                    if diff.b_path is not None:
-                        staged.add(diff.b_path)
+        return added, changed, removed
 
-            for file_name in repo.untracked_files:
-                if path_in_dam(file_name):
-                    staged.add(file_name)
 
-            for p in staged:
-                repo.git.add(p)
+def describe_errors(errors, name):
+    """
+    Describes the errors returned by run_dag(), one per line. name(node) gives how a node is
+    shown, including the failed parent of the nodes that were skipped.
+    """
+
+    return '\n'.join('  {}: {}'.format(
+        name(node),
+        SkippedNode.MESSAGE.format(name(e.parent)) if isinstance(e, SkippedNode) else e
+    ) for node, e in errors)
+
+
+def describe_status(status):
+    """
+    Describes the status of a target (see Castor.status()) in a few words
+    """
+
+    if 'error' in status:
+        return 'error: {}'.format(status['error'])
+    elif status['missing']:
+        return 'not cloned'
+
+    pinned = status['version'] or (status['pinned'] or '')[:10]
+    words = []
+
+    if status['pinned'] is None:
+        words.append('at {}, {} not found'.format(status['head'][:10],
+                                                  pinned or 'pinned commit'))
+    elif status['head'] == status['pinned']:
+        words.append('at {}'.format(pinned))
+    elif status['ahead'] is None:
+        words.append('at {}, moved from {}'.format(status['head'][:10], pinned))
+    else:
+        words.append('at {}, {} ahead and {} behind {}'.format(status['head'][:10],
+                                                               status['ahead'],
+                                                               status['behind'], pinned))
+
+    if status['branch'] is not None:
+        words.append('on branch {}'.format(status['branch']))
+
+    if status['dirty']:
+        words.append('uncommitted changes')
+
+    if status['untracked']:
+        words.append('untracked files')
+
+    return ', '.join(words)
+
+
+def is_repo_root(root):
+    """
+    Tells if root looks like a Castor repo: it has a Castorfile and is a Git root. Only the file
+    system is checked, the Castorfile is not read.
+    """
+
+    return path.isfile(path.join(root, CASTORFILE_NAME)) \
+        and path.isfile(path.join(root, '.git', 'HEAD'))
 
 
 def validate_repo(root):
@@ -420,31 +1777,18 @@ def validate_repo(root):
     Returns a read-only file-like object to the Castorfile if the repo is valid, or None otherwise.
     """
 
-    castorfile_path = path.join(root, CASTORFILE_NAME)
-    git_dir = path.join(root, '.git')
-
-    if path.exists(castorfile_path) \
-            and path.isfile(castorfile_path) \
-            and path.exists(git_dir) \
-            and path.isdir(git_dir):
-        with open(castorfile_path, 'r') as f:
-            s = StringIO(f.read())
-            s.seek(0)
-            if not validate_castorfile(s):
-                return
+    if is_repo_root(root):
+        contents = read_castorfile(root)
 
-            # noinspection PyBroadException
-            try:
-                git.Repo(root)
-                s.seek(0)
-                return s
-            except:
-                return
+        if contents is not None:
+            return StringIO(json.dumps(contents))
 
 
 def find_repo(from_path):
     """
-    Finds the nearest repo root in the hierarchy starting at and above from_path.
+    Finds the nearest repo root in the hierarchy starting at and above from_path. Ancestors are
+    only looked at with stat() calls, the Castorfile being read and validated only for roots that
+    look like a Castor repo.
     """
 
     next_candidate = path.realpath(from_path)
@@ -453,23 +1797,88 @@ def find_repo(from_path):
     while next_candidate != candidate:
         candidate = next_candidate
 
-        if validate_repo(candidate) is not None:
+        if is_repo_root(candidate) and read_castorfile(candidate) is not None:
             return candidate
 
         next_candidate = path.dirname(candidate)
 
 
+@lru_cache(maxsize=None)
+def castorfile_validator():
+    """
+    Returns the validator of the Castorfile schema, which is only built once
+    """
+
+    return jsonschema.validators.validator_for(CASTORFILE_SCHEMA)(CASTORFILE_SCHEMA)
+
+
+@lru_cache(maxsize=None)
+def schema_digest():
+    return hashlib.sha1(json.dumps(CASTORFILE_SCHEMA, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def validate_castorfile(fp):
     """
     Returns True if the given file-like object points to a valid Castorfile, false otherwise.
     """
 
-    contents = json.load(fp)
+    return castorfile_validator().is_valid(json.load(fp))
+
+
+CASTORFILES = {}
+
+
+def read_castorfile(root):
+    """
+    Parses and validates the Castorfile of root, returning its content or None if it is not
+    valid.
+
+    The content is kept for the rest of the process as long as the file does not change, and the
+    digest of the last valid Castorfile is written into the state directory (if it exists), so
+    that an unchanged Castorfile is not validated again by the next runs.
+    """
+
+    castorfile_path = path.realpath(path.join(root, CASTORFILE_NAME))
+
     try:
-        jsonschema.validate(contents, CASTORFILE_SCHEMA)
-        return True
-    except jsonschema.ValidationError:
-        return False
+        st = stat(castorfile_path)
+    except OSError:
+        return None
+
+    signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+    known = CASTORFILES.get(castorfile_path)
+
+    if known is None or known[0] != signature:
+        try:
+            with open(castorfile_path, 'rb') as f:
+                data = f.read()
+
+            contents = json.loads(data.decode('utf-8'))
+        except (IOError, ValueError):
+            return None
+
+        digest = hashlib.sha1(schema_digest().encode('utf-8') + data).hexdigest()
+        mark_path = path.join(path.dirname(castorfile_path), STATE_DIR, VALIDATED_NAME)
+
+        try:
+            with open(mark_path, 'r') as f:
+                validated = f.read().strip() == digest
+        except IOError:
+            validated = False
+
+        if not validated:
+            if not castorfile_validator().is_valid(contents):
+                return None
+
+            if path.isdir(path.dirname(mark_path)):
+                with open(mark_path + '.tmp', 'w') as f:
+                    f.write(digest + '\n')
+
+                replace(mark_path + '.tmp', mark_path)
+
+        known = CASTORFILES[castorfile_path] = (signature, contents)
+
+    return deepcopy(known[1])
 
 
 def init(root):
@@ -515,6 +1924,169 @@ def init(root):
     repo.index.commit('Initial Castor Commit')
 
 
+def fetch_version(g, version, depth=None, clone_filter=None):
+    """
+    Fetches only the given version (tag, branch or commit) from origin instead of all the refs,
+    without following the other tags. Returns True if the version could be fetched.
+    """
+
+    args = ['--no-tags']
+
+    if depth is not None:
+        args.append('--depth={}'.format(depth))
+
+    if clone_filter is not None:
+        args.append('--filter={}'.format(clone_filter))
+
+    refspecs = [
+        '+refs/tags/{0}:refs/tags/{0}',
+        '+refs/heads/{0}:refs/remotes/origin/{0}',
+        '{0}',
+    ]
+
+    if re.match(r'^[0-9a-f]{40}$', version):
+        refspecs.insert(0, refspecs.pop())
+
+    for refspec in refspecs:
+        try:
+            g.fetch(*(args + ['origin', refspec.format(version)]))
+            return True
+        except git.GitCommandError:
+            pass
+
+    return False
+
+
+def clone_partial(source, target_path, version, depth=None, clone_filter=None):
+    """
+    Creates a shallow and/or partial clone of source into target_path, which only contains the
+    requested version.
+    """
+
+    makedirs(target_path, exist_ok=True)
+    git.Git(target_path).init()
+
+    g = git.Git(target_path)
+    g.remote('add', 'origin', source)
+
+    if clone_filter is not None:
+        g.config('core.repositoryformatversion', '1')
+        g.config('extensions.partialClone', 'origin')
+        g.config('remote.origin.promisor', 'true')
+        g.config('remote.origin.partialclonefilter', clone_filter)
+
+    if not fetch_version(g, version, depth, clone_filter):
+        rmtree(target_path)
+        raise git.GitCommandError(['git', 'fetch', 'origin', version], 128)
+
+
+def update_submodules(target_path, jobs=1, depth=None):
+    """
+    Initializes and updates all the submodules of a clone, recursively, with a single git call
+    that fetches up to `jobs` submodules at the same time. With `depth`, submodules are shallow
+    clones.
+    """
+
+    if not read_gitmodules(target_path):
+        return
+
+    args = ['update', '--init', '--recursive', '--jobs', str(max(jobs, 1))]
+
+    if depth is not None:
+        args += ['--depth', str(depth)]
+
+    git.Git(target_path).submodule(*args)
+
+
+def print_prefixed(prefix, line):
+    """
+    Prints a line of output, prefixed by the name of what produced it. Lines printed from
+    different threads never get mixed up.
+    """
+
+    with OUTPUT_LOCK:
+        sys.stdout.write('{} {}\n'.format(prefix, line))
+        sys.stdout.flush()
+
+
+def run_command(command, cwd, prefix, timeout=None):
+    """
+    Runs a command line in cwd, printing its output (stdout and stderr) line by line with the
+    given prefix. Raises a CastorException if the command can't be started, exits with a non-zero
+    status or runs for more than `timeout` seconds (in which case it is killed).
+    """
+
+    try:
+        proc = subprocess.Popen(shlex.split(command), cwd=cwd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, start_new_session=True)
+    except OSError as e:
+        raise CastorException('Could not run "{}": {}'.format(command, e))
+
+    def forward():
+        for line in iter(proc.stdout.readline, b''):
+            print_prefixed(prefix, line.decode('utf-8', 'replace').rstrip('\n'))
+
+    reader = Thread(target=forward)
+    reader.daemon = True
+    reader.start()
+
+    try:
+        code = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+        reader.join()
+        raise CastorException('"{}" timed out after {} seconds'.format(command, timeout))
+    finally:
+        reader.join()
+        proc.stdout.close()
+
+    if code != 0:
+        raise CastorException('"{}" exited with status {}'.format(command, code))
+
+
+def write_managed_lines(file_path, lines):
+    """
+    Replaces the block of lines managed by Castor in the given file. The file is read once and
+    atomically replaced, and only if its content changes. Lines outside of the block that are
+    duplicates of managed lines (as written by older versions of Castor) are removed.
+    """
+
+    try:
+        with open(file_path, 'r') as f:
+            content = f.read()
+    except IOError:
+        content = None
+
+    managed = set(x.strip() for x in lines)
+    kept = []
+    in_block = False
+
+    for line in (content or '').splitlines():
+        if line.strip() == MANAGED_BEGIN:
+            in_block = True
+        elif line.strip() == MANAGED_END:
+            in_block = False
+        elif not in_block and line.strip() not in managed:
+            kept.append(line)
+
+    if lines:
+        kept += [MANAGED_BEGIN] + list(lines) + [MANAGED_END]
+
+    new_content = ''.join(x + '\n' for x in kept)
+
+    if new_content == content or (content is None and not lines):
+        return
+
+    makedirs(path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.castor-tmp'
+
+    with open(tmp_path, 'w') as f:
+        f.write(new_content)
+
+    replace(tmp_path, file_path)
+
+
 def ensure_line_in_file(file_path, line):
     """
     Ensure that the line exists in the file at file_path. If the line has no line feed at the end,
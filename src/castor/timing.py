@@ -0,0 +1,273 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import json
+import time
+import subprocess
+
+from os import getpid, path
+from threading import Lock, local, get_ident
+
+CATEGORY_CASTOR = 'castor'
+CATEGORY_SUBPROCESS = 'subprocess'
+
+
+class NullSpan(object):
+    """
+    Span used when tracing is disabled, which does nothing at all
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    Measures the time spent in a `with` block. Spans without a target inherit the target of the
+    span they are nested in, on the same thread.
+    """
+
+    def __init__(self, tracer, name, target, args):
+        self.tracer = tracer
+        self.name = name
+        self.target = target
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+
+        if self.target is None and stack:
+            self.target = stack[-1].target
+
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end = time.perf_counter()
+        self.tracer.stack().pop()
+
+        args = dict(self.args)
+
+        if exc_type is not None:
+            args['error'] = str(exc_val)
+
+        self.tracer.record(self.name, CATEGORY_CASTOR, self.target, self.start, end, args)
+        return False
+
+
+class Tracer(object):
+    """
+    Records the spans of a run, as well as the subprocesses it spawned, in order to display a
+    summary of where the time went or to write a Chrome trace (which can be opened in
+    chrome://tracing or Perfetto).
+
+    Nothing is recorded, and subprocess.Popen is left untouched, until enable() is called.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = Lock()
+        self.local = local()
+        self.origin = None
+        self.threads = {}
+        self.original_popen = None
+
+    def enable(self):
+        if self.enabled:
+            return
+
+        self.enabled = True
+        self.origin = time.perf_counter()
+        self.patch_popen()
+
+    def disable(self):
+        if not self.enabled:
+            return
+
+        self.enabled = False
+
+        for name, method in self.original_popen.items():
+            setattr(subprocess.Popen, name, method)
+
+        self.original_popen = None
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def span(self, name, target=None, **args):
+        """
+        Returns a context manager which records the time spent in its block as a span
+        """
+
+        if not self.enabled:
+            return NULL_SPAN
+
+        return Span(self, name, target, args)
+
+    def record(self, name, category, target, start, end, args):
+        with self.lock:
+            tid = self.threads.setdefault(get_ident(), len(self.threads) + 1)
+            self.events.append((name, category, target, start, end, tid, args))
+
+    def patch_popen(self):
+        """
+        Wraps subprocess.Popen so that each process is recorded as a span, from its creation to
+        the moment it is waited for.
+        """
+
+        tracer = self
+        init = subprocess.Popen.__init__
+        wait = subprocess.Popen.wait
+        poll = subprocess.Popen.poll
+
+        self.original_popen = {'__init__': init, 'wait': wait, 'poll': poll}
+
+        def done(proc):
+            start = proc.__dict__.pop('_castor_start', None)
+
+            if start is not None and proc.returncode is not None:
+                name, command = command_name(proc.args)
+                target = proc.__dict__.pop('_castor_target', None)
+                tracer.record(name, CATEGORY_SUBPROCESS, target, start, time.perf_counter(),
+                              {'command': command, 'status': proc.returncode})
+
+        def traced_init(proc, *args, **kwargs):
+            stack = tracer.stack()
+            proc._castor_target = stack[-1].target if stack else None
+            proc._castor_start = time.perf_counter()
+            init(proc, *args, **kwargs)
+
+        def traced_wait(proc, *args, **kwargs):
+            out = wait(proc, *args, **kwargs)
+            done(proc)
+            return out
+
+        def traced_poll(proc):
+            out = poll(proc)
+            done(proc)
+            return out
+
+        subprocess.Popen.__init__ = traced_init
+        subprocess.Popen.wait = traced_wait
+        subprocess.Popen.poll = traced_poll
+
+    def summary(self):
+        """
+        Returns a table of the time spent in each phase and in each kind of subprocess, the
+        slowest first. The slowest target of each phase is given as well.
+        """
+
+        phases = {}
+
+        with self.lock:
+            events = list(self.events)
+
+        for name, category, target, start, end, _, _ in events:
+            phase = phases.setdefault((category, name), [0, 0.0, 0.0, None])
+            duration = end - start
+            phase[0] += 1
+            phase[1] += duration
+
+            if duration >= phase[2]:
+                phase[2] = duration
+                phase[3] = target
+
+        lines = ['{:<10} {:<24} {:>6} {:>10} {:>10}  {}'.format(
+            'Category', 'Phase', 'Count', 'Total (s)', 'Max (s)', 'Slowest target'
+        )]
+
+        for (category, name), (count, total, longest, target) in sorted(
+                phases.items(), key=lambda x: (x[0][0], -x[1][1])):
+            lines.append('{:<10} {:<24} {:>6} {:>10.3f} {:>10.3f}  {}'.format(
+                category, name, count, total, longest, target or ''
+            ))
+
+        return '\n'.join(lines) + '\n'
+
+    def trace(self):
+        """
+        Returns the recorded spans in the Chrome trace event format
+        """
+
+        pid = getpid()
+        out = []
+
+        with self.lock:
+            events = list(self.events)
+
+        for name, category, target, start, end, tid, args in sorted(events, key=lambda x: x[3]):
+            args = dict(args)
+
+            if target is not None:
+                args['target'] = target
+
+            out.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6, 1),
+                'dur': round((end - start) * 1e6, 1),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+
+        return {'traceEvents': out, 'displayTimeUnit': 'ms'}
+
+    def write_trace(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.trace(), f)
+
+
+def command_name(args):
+    """
+    Returns a short name for a command (like "git fetch") and its full command line
+    """
+
+    if isinstance(args, (list, tuple)):
+        words = [str(x) for x in args]
+    else:
+        words = str(args).split()
+
+    if not words:
+        return '?', ''
+
+    name = path.basename(words[0])
+
+    if name == 'git':
+        i = 1
+
+        # Skip the global options, some of which take a value
+        while i < len(words) and words[i].startswith('-'):
+            i += 2 if words[i] in ('-c', '-C') else 1
+
+        if i < len(words):
+            name = 'git {}'.format(words[i])
+
+    return name, ' '.join(words)[:200]
+
+
+TRACER = Tracer()
+
+
+def span(name, target=None, **args):
+    """
+    Records the time spent in a `with` block, when tracing is enabled
+    """
+
+    return TRACER.span(name, target, **args)
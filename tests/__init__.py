@@ -5,3 +5,8 @@
 # Rémy Sanchez <remy.sanchez@activkonnect.com>
 
 from .repo import *
+from .pool import *
+from .cache import *
+from .plumbing import *
+from .timing import *
+from .filters import *
@@ -0,0 +1,167 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import unittest
+import git
+
+from threading import Thread
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import path, makedirs, listdir
+from castor.cache import normalize_url, cache_key, parse_size, snapshot, ObjectCache, \
+    OutputCache
+
+
+class TestNormalizeUrl(unittest.TestCase):
+    def test_same_upstream(self):
+        urls = [
+            'git@github.com:PrestaShop/PrestaShop.git',
+            'https://github.com/PrestaShop/PrestaShop',
+            'https://user@GitHub.com/PrestaShop/PrestaShop.git/',
+            'ssh://git@github.com:22/PrestaShop/PrestaShop.git',
+        ]
+
+        self.assertEqual({normalize_url(x) for x in urls}, {'github.com/PrestaShop/PrestaShop'})
+        self.assertEqual(len({cache_key(x) for x in urls}), 1)
+
+    def test_different_upstream(self):
+        self.assertNotEqual(cache_key('https://github.com/a/b.git'),
+                            cache_key('https://github.com/a_b.git'))
+
+
+class TestParseSize(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('12'), 12)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5G'), 1536 * 1024 * 1024)
+        self.assertEqual(parse_size('3MiB'), 3 * 1024 * 1024)
+
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+
+class TestObjectCache(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.upstream = path.join(self.workdir, 'upstream')
+
+        repo = git.Repo.init(self.upstream)
+        with open(path.join(self.upstream, 'test.txt'), 'w') as f:
+            f.write('hello')
+        repo.index.add(['test.txt'])
+        repo.index.commit('Initial commit')
+
+        self.cache = ObjectCache(path.join(self.workdir, 'cache'))
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def test_ensure(self):
+        with self.cache.ensure('file://' + self.upstream) as mirror:
+            self.assertTrue(git.Repo(mirror).bare)
+
+        with self.cache.ensure('file://' + self.upstream + '/') as other:
+            self.assertEqual(mirror, other)
+
+        self.assertEqual([x[0] for x in self.cache.mirrors()], [mirror])
+
+    def test_refs(self):
+        upstream = git.Repo(self.upstream)
+        upstream.create_tag('v1')
+        upstream.git.update_ref('refs/pull/1/head', 'HEAD')
+
+        with self.cache.ensure('file://' + self.upstream) as mirror:
+            pass
+
+        upstream.create_head('other')
+
+        with self.cache.ensure('file://' + self.upstream) as mirror:
+            refs = git.Repo(mirror).git.for_each_ref('--format=%(refname)').splitlines()
+
+        self.assertEqual(refs, [
+            'refs/heads/' + upstream.active_branch.name,
+            'refs/heads/other',
+            'refs/tags/v1',
+        ])
+
+    def test_locked_while_used(self):
+        with self.cache.ensure('file://' + self.upstream) as mirror:
+            clear = Thread(target=self.cache.clear)
+            clear.start()
+            clear.join(0.2)
+
+            self.assertTrue(clear.is_alive())
+            self.assertTrue(path.isdir(mirror))
+
+        clear.join()
+
+        self.assertFalse(path.exists(mirror))
+
+    def test_prune(self):
+        with self.cache.ensure('file://' + self.upstream):
+            pass
+
+        self.assertEqual(self.cache.prune(), [])
+        self.assertEqual(len(self.cache.prune(max_size=0)), 1)
+        self.assertEqual(self.cache.mirrors(), [])
+
+    def test_clear(self):
+        with self.cache.ensure('file://' + self.upstream):
+            pass
+
+        self.assertEqual(len(self.cache.clear()), 1)
+        self.assertEqual(listdir(self.cache.root), [])
+
+
+class TestOutputCache(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.cache = OutputCache(path.join(self.workdir, 'cache'), keep=1)
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def make_target(self, name):
+        target = path.join(self.workdir, name)
+        makedirs(path.join(target, 'old'))
+
+        for file_name in ('keep', 'old/file'):
+            with open(path.join(target, file_name), 'w') as f:
+                f.write(file_name)
+
+        return target
+
+    def test_replay(self):
+        src = self.make_target('src')
+        before = snapshot(src)
+
+        rmtree(path.join(src, 'old'))
+        makedirs(path.join(src, 'new'))
+
+        with open(path.join(src, 'new', 'file'), 'w') as f:
+            f.write('built')
+
+        self.cache.store('key', '/src', src, before)
+
+        dest = self.make_target('dest')
+
+        self.assertFalse(self.cache.replay('other', dest))
+        self.assertTrue(self.cache.replay('key', dest))
+        self.assertEqual(snapshot(dest).keys(), {'keep', 'new', 'new/file'})
+
+        with open(path.join(dest, 'new', 'file'), 'r') as f:
+            self.assertEqual(f.read(), 'built')
+
+    def test_keep(self):
+        src = self.make_target('src')
+
+        self.cache.store('key1', '/src', src, {})
+        self.cache.store('key2', '/src', src, {})
+        self.cache.store('key3', '/other', src, {})
+
+        self.assertFalse(self.cache.replay('key1', src))
+        self.assertTrue(self.cache.replay('key2', src))
+        self.assertTrue(self.cache.replay('key3', src))
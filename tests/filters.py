@@ -0,0 +1,40 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import unittest
+
+from castor.filters import PathFilter, path_filter
+
+
+class TestPathFilter(unittest.TestCase):
+    def assertAccepts(self, f, accepted, rejected):
+        self.assertEqual([x for x in accepted + rejected if f.accept(x)], accepted)
+
+    def test_name_patterns(self):
+        self.assertAccepts(
+            PathFilter(['tests', '*.md']),
+            ['testsuite/a.php', 'src/a.php', 'md'],
+            ['tests', 'tests/a.php', 'a/tests/b/c.php', 'README.md', 'docs/a.md'],
+        )
+
+    def test_path_patterns(self):
+        self.assertAccepts(
+            PathFilter(['/docs/', 'vendor/*/doc', '**/*.log', 'img/[!a]*.png']),
+            ['docs', 'a/docs/x', 'vendor/a/b/doc/x', 'img/a.png', 'img/sub/b.png'],
+            ['docs/a', 'vendor/a/doc/x', 'a.log', 'a/b/c.log', 'img/b.png'],
+        )
+
+    def test_include(self):
+        self.assertAccepts(
+            PathFilter(['*.md'], ['/README.md', 'docs/**']),
+            ['README.md', 'docs/a/b.md', 'a.php'],
+            ['a/README.md', 'CHANGELOG.md'],
+        )
+
+    def test_empty(self):
+        self.assertFalse(PathFilter())
+        self.assertTrue(PathFilter().accept('tests/a.php'))
+        self.assertIs(path_filter(('a', ), ()), path_filter(('a', ), ()))
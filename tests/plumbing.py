@@ -0,0 +1,157 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import unittest
+import git
+
+from shutil import rmtree
+from tempfile import mkdtemp
+from os import path, makedirs, listdir, stat
+from castor.plumbing import ls_tree, diff_tree, extract_archive, link_tree, materialize, \
+    RefIndex, read_head, read_gitmodules, submodule_paths, list_sources, sync_files
+
+
+class TestPlumbing(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.repo_path = path.join(self.workdir, 'repo')
+        self.repo = git.Repo.init(self.repo_path)
+
+        self.commit({'a.txt': 'a', 'sub/b.txt': 'b', '.gitignore': '*.log'})
+        self.first = self.repo.head.commit.hexsha
+
+        self.repo.index.remove(['a.txt'], working_tree=True)
+        self.commit({'sub/b.txt': 'bb', 'c.txt': 'c'})
+        self.second = self.repo.head.commit.hexsha
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def commit(self, files):
+        for name, content in files.items():
+            file_path = path.join(self.repo_path, name)
+            makedirs(path.dirname(file_path), exist_ok=True)
+
+            with open(file_path, 'w') as f:
+                f.write(content)
+
+        self.repo.index.add(list(files.keys()))
+        self.repo.index.commit('Commit')
+
+    def test_ls_tree(self):
+        tree = ls_tree(self.repo, self.first)
+
+        self.assertEqual(set(tree.keys()), {'a.txt', 'sub/b.txt', '.gitignore'})
+        self.assertEqual(tree['a.txt'][0], '100644')
+
+    def test_diff_tree(self):
+        changes = {x[5]: x[4] for x in diff_tree(self.repo, self.first, self.second)}
+        self.assertEqual(changes, {'a.txt': 'D', 'sub/b.txt': 'M', 'c.txt': 'A'})
+
+    def test_extract_archive(self):
+        dest = path.join(self.workdir, 'out')
+        extract_archive(self.repo, dest, self.first, lambda x: x != '.gitignore')
+
+        self.assertEqual(set(listdir(dest)), {'a.txt', 'sub'})
+
+        with open(path.join(dest, 'sub', 'b.txt')) as f:
+            self.assertEqual(f.read(), 'b')
+
+    def test_link_tree(self):
+        dest = path.join(self.workdir, 'out')
+        self.assertTrue(link_tree(self.repo, dest, 'hardlink'))
+
+        self.assertEqual(set(listdir(dest)), {'.gitignore', 'c.txt', 'sub'})
+        self.assertEqual(stat(path.join(dest, 'c.txt')).st_ino,
+                         stat(path.join(self.repo_path, 'c.txt')).st_ino)
+
+    def test_link_tree_dirty(self):
+        with open(path.join(self.repo_path, 'c.txt'), 'w') as f:
+            f.write('dirty')
+
+        self.assertFalse(link_tree(self.repo, path.join(self.workdir, 'out'), 'hardlink'))
+
+    def test_materialize_fallback(self):
+        dest = path.join(self.workdir, 'c.txt')
+        materialize(path.join(self.repo_path, 'c.txt'), dest, 'reflink')
+
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'c')
+
+    def test_ref_index(self):
+        self.repo.create_tag('light', self.first)
+        self.repo.create_tag('annotated', self.first, message='Annotated')
+        refs = RefIndex(self.repo)
+
+        self.assertEqual(refs.tags(self.first), ['annotated', 'light'])
+        self.assertIn(self.repo.active_branch.name, refs.names(self.second))
+        self.assertEqual(refs.resolve('annotated'), self.first)
+        self.assertEqual(refs.resolve(self.second[:10]), self.second)
+        self.assertIsNone(refs.resolve('nope'))
+        self.assertIsNone(refs.resolve('deadbeef'))
+
+    def test_read_head(self):
+        branch = self.repo.active_branch.name
+        self.assertEqual(read_head(self.repo_path), ('refs/heads/' + branch, self.second))
+
+        self.repo.git.pack_refs('--all')
+        self.assertEqual(read_head(self.repo_path), ('refs/heads/' + branch, self.second))
+
+        self.repo.git.checkout(self.first)
+        self.assertEqual(read_head(self.repo_path), (None, self.first))
+        self.assertEqual(read_head(self.workdir), (None, None))
+
+    def test_submodule_paths(self):
+        with open(path.join(self.repo_path, '.gitmodules'), 'w') as f:
+            f.write('[submodule "mods/a"]\n'
+                    '\tpath = mods/a\n'
+                    '\turl = https://example.com/a.git\n'
+                    '; comment\n'
+                    '[submodule "b"]\n'
+                    '\tpath = "mods/b"\n'
+                    '[core]\n'
+                    '\tpath = nope\n')
+
+        self.assertEqual(read_gitmodules(self.repo_path), {
+            'mods/a': {'path': 'mods/a', 'url': 'https://example.com/a.git'},
+            'b': {'path': 'mods/b'},
+        })
+        self.assertEqual(submodule_paths(self.repo_path), [])
+
+        git.Repo.init(path.join(self.repo_path, 'mods', 'b'))
+        self.assertEqual(submodule_paths(self.repo_path), ['mods/b'])
+        self.assertEqual(read_gitmodules(self.workdir), {})
+
+    def test_list_sources(self):
+        sub = path.join(self.repo_path, 'sub')
+
+        self.assertEqual(list_sources(path.join(sub, 'b.txt')), {'': path.join(sub, 'b.txt')})
+        self.assertEqual(list_sources(sub), {'b.txt': path.join(sub, 'b.txt')})
+        self.assertEqual(list_sources(path.join(self.repo_path, '*.txt')),
+                         {'c.txt': path.join(self.repo_path, 'c.txt')})
+        self.assertEqual(list_sources(path.join(self.repo_path, '**', '*.txt')), {
+            'c.txt': path.join(self.repo_path, 'c.txt'),
+            'sub/b.txt': path.join(sub, 'b.txt'),
+        })
+        self.assertEqual(list_sources(path.join(self.repo_path, 's*', '**')),
+                         {'sub/b.txt': path.join(sub, 'b.txt')})
+
+    def test_sync_files(self):
+        dest = path.join(self.workdir, 'out')
+        files = list_sources(self.repo_path + '/**/*.txt')
+
+        self.assertEqual(sync_files(files, dest, jobs=4), ['c.txt', 'sub/b.txt'])
+        self.assertEqual(sync_files(files, dest, jobs=4), [])
+
+        with open(path.join(self.repo_path, 'c.txt'), 'w') as f:
+            f.write('C')
+
+        del files['sub/b.txt']
+        self.assertEqual(sync_files(files, dest, ['c.txt', 'sub/b.txt']), ['c.txt'])
+        self.assertEqual(listdir(dest), ['c.txt'])
+
+        with open(path.join(dest, 'c.txt')) as f:
+            self.assertEqual(f.read(), 'C')
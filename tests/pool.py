@@ -0,0 +1,72 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import unittest
+
+from threading import Lock
+from castor.pool import nest_parents, run_dag, SkippedNode
+
+
+class TestNestParents(unittest.TestCase):
+    def test_nest_parents(self):
+        parents = nest_parents(
+            ['/l/', '/l/a', '/l/m/test', '/l/m/test/x', '/l/m/testing'],
+            ['/l/', '/l/m/test'],
+        )
+
+        self.assertEqual(parents, {
+            '/l/': None,
+            '/l/a': '/l/',
+            '/l/m/test': '/l/',
+            '/l/m/test/x': '/l/m/test',
+            '/l/m/testing': '/l/',
+        })
+
+
+class TestRunDag(unittest.TestCase):
+    def run_tree(self, jobs):
+        nodes = ['a', 'a/b', 'a/b/c', 'a/d', 'e']
+        parents = {'a/b': 'a', 'a/b/c': 'a/b', 'a/d': 'a'}
+        done = []
+        lock = Lock()
+
+        def func(node):
+            with lock:
+                if node in parents:
+                    self.assertIn(parents[node], done)
+                done.append(node)
+
+        self.assertEqual(run_dag(nodes, parents, func, jobs), [])
+        self.assertEqual(set(done), set(nodes))
+
+        return done
+
+    def test_serial_order(self):
+        self.assertEqual(self.run_tree(1), ['a', 'a/b', 'a/b/c', 'a/d', 'e'])
+
+    def test_parallel(self):
+        self.run_tree(4)
+
+    def test_errors(self):
+        nodes = ['a', 'a/b', 'a/b/c', 'c', 'd']
+        parents = {'a/b': 'a', 'a/b/c': 'a/b'}
+        done = []
+
+        def func(node):
+            if node in ('a', 'c'):
+                raise ValueError(node)
+            done.append(node)
+
+        for jobs in (1, 3):
+            del done[:]
+            errors = dict(run_dag(nodes, parents, func, jobs))
+
+            self.assertEqual(sorted(errors), ['a', 'a/b', 'a/b/c', 'c'])
+            self.assertIsInstance(errors['a'], ValueError)
+            self.assertIsInstance(errors['a/b'], SkippedNode)
+            self.assertEqual(errors['a/b/c'].parent, 'a')
+            self.assertEqual(str(errors['a/b/c']), 'skipped: parent a failed')
+            self.assertEqual(done, ['d'])
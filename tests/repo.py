@@ -5,18 +5,96 @@
 # Rémy Sanchez <remy.sanchez@activkonnect.com>
 
 import json
+import tarfile
 import unittest
 import git
 
+from contextlib import contextmanager
 from shutil import rmtree, copytree
 from tempfile import mkdtemp, NamedTemporaryFile
-from os import path, rename, walk
+from os import path, rename, walk, makedirs, unlink, environ
 from castor.repo import validate_castorfile, find_repo, Castor, CastorException, init, \
-    ensure_line_in_file
+    ensure_line_in_file, clone_partial, write_managed_lines, run_command, read_castorfile, \
+    describe_status
+from castor.plumbing import LINK_HARDLINK
 
 ASSETS_ROOT = path.join(path.dirname(__file__), 'assets')
 
 
+def make_upstream(repo_path, versions):
+    """
+    Creates a local repo with one commit per version, each of them writing the version into
+    test.txt and being tagged with it.
+    """
+
+    repo = git.Repo.init(repo_path)
+
+    for version in versions:
+        with open(path.join(repo_path, 'test.txt'), 'w') as f:
+            f.write(version)
+
+        repo.index.add(['test.txt'])
+        repo.index.commit(version)
+        repo.create_tag(version)
+
+    return repo
+
+
+def make_project(workdir):
+    """
+    Creates a Castor project in workdir/repo, made of two local upstreams and a file target, in
+    order to run tests without network access.
+    """
+
+    root = path.join(workdir, 'repo')
+    make_upstream(path.join(workdir, 'up1'), ['v1', 'v2'])
+    make_upstream(path.join(workdir, 'up2'), ['v1'])
+    init(root)
+
+    with open(path.join(root, 'htaccess'), 'w') as f:
+        f.write('Require all granted\n')
+
+    with open(path.join(root, 'Castorfile'), 'w') as f:
+        json.dump({'lodge': [
+            {
+                'target': '/',
+                'type': 'git',
+                'repo': 'file://' + path.join(workdir, 'up1'),
+                'version': 'v1',
+            },
+            {
+                'target': '/.htaccess',
+                'type': 'file',
+                'source': 'htaccess',
+            },
+            {
+                'target': '/modules/test',
+                'type': 'git',
+                'repo': 'file://' + path.join(workdir, 'up2'),
+                'version': 'v1',
+            },
+        ]}, f)
+
+    return root
+
+
+def list_files(root):
+    """
+    Returns a dictionary of all files below root with their content
+    """
+
+    out = {}
+
+    for dir_path, dir_names, file_names in walk(root):
+        for file_name in file_names:
+            file_path = path.join(dir_path, file_name)
+
+            with open(file_path, 'r') as f:
+                out[path.relpath(file_path, root)] = f.read()
+
+    return out
+
+
 class TestValidateCastorfile(unittest.TestCase):
     def test_validate_1(self):
         with open(path.join(ASSETS_ROOT, 'test1', 'Castorfile')) as f:
@@ -41,6 +119,28 @@ class TestRepoDiscovery(unittest.TestCase):
         finally:
             rename(tmp_git, stock_git)
 
+    def test_read_castorfile(self):
+        workdir = mkdtemp()
+
+        try:
+            root = make_project(workdir)
+            makedirs(path.join(root, '.castor'))
+
+            first = read_castorfile(root)
+            first['lodge'] = []
+
+            self.assertEqual(len(read_castorfile(root)['lodge']), 3)
+            self.assertTrue(path.exists(path.join(root, '.castor', 'castorfile.valid')))
+            self.assertEqual(find_repo(path.join(root, 'lodge', 'some', 'path')), root)
+
+            with open(path.join(root, 'Castorfile'), 'w') as f:
+                json.dump({'lodge': [{'target': 'relative'}]}, f)
+
+            self.assertIsNone(read_castorfile(root))
+            self.assertIsNone(find_repo(root))
+        finally:
+            rmtree(workdir)
+
 
 class TestCastorInit(unittest.TestCase):
     def test_init_fail_does_not_exist(self):
@@ -76,6 +176,842 @@ class TestCastorInit(unittest.TestCase):
             rmtree(dir_name)
 
 
+class TestClonePartial(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.upstream = path.join(self.workdir, 'upstream')
+        self.clone = path.join(self.workdir, 'clone')
+        make_upstream(self.upstream, ['v1', 'v2', 'v3'])
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def test_shallow_tag(self):
+        clone_partial('file://' + self.upstream, self.clone, 'v2', depth=1)
+        repo = git.Repo(self.clone)
+
+        self.assertEqual([x.name for x in repo.tags], ['v2'])
+        self.assertEqual(len(list(repo.iter_commits('v2'))), 1)
+
+    def test_shallow_commit(self):
+        sha = git.Repo(self.upstream).commit('v1').hexsha
+        clone_partial('file://' + self.upstream, self.clone, sha, depth=1)
+
+        self.assertEqual(git.Repo(self.clone).commit(sha).message, 'v1')
+
+    def test_missing_version(self):
+        with self.assertRaises(git.GitCommandError):
+            clone_partial('file://' + self.upstream, self.clone, 'nope', depth=1)
+
+        self.assertFalse(path.exists(self.clone))
+
+    def test_shallow_branch(self):
+        upstream = git.Repo(self.upstream)
+        branch = upstream.active_branch.name
+        Castor.apply_git(self.clone, 'file://' + self.upstream, branch, depth=1)
+
+        upstream.create_head('other')
+        make_upstream(self.upstream, ['v4'])
+        Castor.apply_git(self.clone, 'file://' + self.upstream, branch, depth=1)
+        repo = git.Repo(self.clone)
+
+        self.assertEqual(repo.head.commit.hexsha, upstream.head.commit.hexsha)
+        self.assertEqual(len(list(repo.iter_commits())), 2)
+        self.assertEqual([x.name for x in repo.tags], [])
+        self.assertEqual([x.name for x in repo.remotes.origin.refs], ['origin/' + branch])
+
+
+class TestApplyGitSubmodules(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.upstream = path.join(self.workdir, 'upstream')
+        sub = make_upstream(path.join(self.workdir, 'sub'), ['s1', 's2'])
+        repo = make_upstream(self.upstream, ['v1'])
+
+        with open(path.join(self.upstream, '.gitmodules'), 'w') as f:
+            f.write('[submodule "libs/sub"]\n\tpath = libs/sub\n\turl = {}\n'.format(
+                sub.working_dir
+            ))
+
+        repo.git.update_index('--add', '--cacheinfo',
+                              '160000,{},libs/sub'.format(sub.commit('s1').hexsha))
+        repo.index.add(['.gitmodules'])
+        repo.git.commit('-m', 'v2')
+        repo.create_tag('v2')
+
+        # Submodules are cloned from local paths
+        self.environ = dict(environ)
+        environ.update({
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'protocol.file.allow',
+            'GIT_CONFIG_VALUE_0': 'always',
+        })
+
+    def tearDown(self):
+        environ.clear()
+        environ.update(self.environ)
+        rmtree(self.workdir)
+
+    def check_apply(self, **kwargs):
+        target = path.join(self.workdir, 'clone-{}'.format(len(kwargs)))
+        Castor.apply_git(target, 'file://' + self.upstream, 'v1', **kwargs)
+        self.assertFalse(path.exists(path.join(target, 'libs', 'sub', 'test.txt')))
+
+        Castor.apply_git(target, 'file://' + self.upstream, 'v2', **kwargs)
+
+        with open(path.join(target, 'libs', 'sub', 'test.txt')) as f:
+            self.assertEqual(f.read(), 's1')
+
+    def test_full_clone(self):
+        self.check_apply()
+
+    def test_shallow_clone(self):
+        self.check_apply(depth=1)
+
+    def test_partial_clone(self):
+        self.check_apply(depth=1, clone_filter='blob:none')
+
+
+class ProjectTestCase(unittest.TestCase):
+    """
+    Runs each test in a fresh project made by make_project()
+    """
+
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.root = make_project(self.workdir)
+        self.dam = path.join(self.root, 'dam')
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def patch_castorfile(self, fn):
+        """
+        Calls fn with the content of the Castorfile and writes it back
+        """
+
+        with open(path.join(self.root, 'Castorfile'), 'r') as f:
+            d = json.load(f)
+
+        fn(d)
+
+        with open(path.join(self.root, 'Castorfile'), 'w') as f:
+            json.dump(d, f)
+
+    @contextmanager
+    def rebuilds(self, castor):
+        """
+        Records the calls to the rebuild_dam() method of castor, instead of rebuilding the dam
+        """
+
+        rebuilt = []
+        castor.rebuild_dam = lambda *args: rebuilt.append(args)
+
+        try:
+            yield rebuilt
+        finally:
+            del castor.rebuild_dam
+
+    @contextmanager
+    def no_rebuild(self, castor):
+        """
+        Makes sure that the dam is only updated incrementally in the block
+        """
+
+        with self.rebuilds(castor) as rebuilt:
+            yield
+
+        self.assertEqual(rebuilt, [])
+
+
+class TestIncrementalDam(ProjectTestCase):
+    def test_update(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        lodge = git.Repo(path.join(self.root, 'lodge'))
+        lodge.git.checkout('v2')
+
+        with open(path.join(self.root, 'lodge', 'added.txt'), 'w') as f:
+            f.write('added')
+
+        lodge.index.add(['added.txt'])
+        lodge.index.commit('Added a file')
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v2',
+            'added.txt': 'added',
+            '.htaccess': 'Require all granted\n',
+            'modules/test/test.txt': 'v1',
+        })
+
+        lodge.git.checkout('v1')
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        self.assertNotIn('added.txt', list_files(self.dam))
+
+    def test_dirty_dam(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        with open(path.join(self.dam, 'test.txt'), 'w') as f:
+            f.write('HACKED')
+
+        with open(path.join(self.dam, 'added.txt'), 'w') as f:
+            f.write('added')
+
+        c.freeze()
+
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v1',
+            '.htaccess': 'Require all granted\n',
+            'modules/test/test.txt': 'v1',
+        })
+        self.assertEqual(git.Repo(self.root).git.diff('--', 'dam'), '')
+
+    def test_hardlinked_lodge_edited(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze(link=LINK_HARDLINK)
+
+        self.assertEqual(c.read_dam_manifest()['hardlinked'], ['/', '/modules/test'])
+
+        with open(path.join(self.root, 'lodge', 'test.txt'), 'w') as f:
+            f.write('edited')
+
+        # The dam is not staged, only the hardlinks tell that it changed
+        manifest = c.read_dam_manifest()
+        del manifest['index_tree']
+        c.write_dam_manifest(manifest)
+
+        with open(path.join(self.dam, 'test.txt'), 'r') as f:
+            self.assertEqual(f.read(), 'edited')
+
+        c.freeze(link=LINK_HARDLINK)
+
+        self.assertEqual(c.read_dam_manifest()['hardlinked'], ['/modules/test'])
+
+        with open(path.join(self.dam, 'test.txt'), 'r') as f:
+            self.assertEqual(f.read(), 'v1')
+
+    def test_new_tag(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        lodge = git.Repo(path.join(self.root, 'lodge'))
+
+        with open(path.join(self.root, 'lodge', 'added.txt'), 'w') as f:
+            f.write('added')
+
+        lodge.index.add(['added.txt'])
+        lodge.index.commit('Added a file')
+        lodge.create_tag('v3')
+        c.freeze()
+
+        self.assertEqual(c.castorfile['lodge'][0]['version'], 'v3')
+
+    def test_freeze_stages_dam(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        status = git.Repo(self.root).git.status('--porcelain', '--', 'dam', 'Castorfile')
+        self.assertEqual(sorted(status.splitlines()), [
+            'A  dam/.htaccess',
+            'A  dam/modules/test/test.txt',
+            'A  dam/test.txt',
+            'M  Castorfile',
+        ])
+
+    def test_parallel_rebuild(self):
+        c = Castor(self.root)
+        c.apply()
+        c.gather_dam(jobs=4)
+
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v1',
+            '.htaccess': 'Require all granted\n',
+            'modules/test/test.txt': 'v1',
+        })
+
+    def test_rebuild_when_index_changed(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        git.Repo(self.root).git.rm('--cached', '-r', 'dam')
+
+        with self.rebuilds(c) as rebuilt:
+            c.gather_dam()
+
+        self.assertEqual(len(rebuilt), 1)
+
+
+class TestApplyState(ProjectTestCase):
+    def test_skip_unchanged(self):
+        c = Castor(self.root)
+        c.apply()
+
+        applied = []
+        c.apply_git = lambda *args: applied.append(args[0])
+        c.apply_file = lambda *args: applied.append(args[1])
+        c.apply()
+
+        self.assertEqual(applied, [])
+
+        with open(path.join(self.root, 'htaccess'), 'w') as f:
+            f.write('Require all denied\n')
+
+        c.castorfile['lodge'][2]['version'] = 'v2'
+        c.apply()
+
+        self.assertEqual(applied, [
+            path.join(self.root, 'lodge', '.htaccess'),
+            path.join(self.root, 'lodge', 'modules', 'test'),
+        ])
+
+        del applied[:]
+        c.apply(force=True)
+
+        self.assertEqual(len(applied), 3)
+
+    def test_exec_post_freeze_later(self):
+        self.patch_castorfile(lambda d: d['lodge'][2].update(post_freeze=['touch built']))
+        built = path.join(self.root, 'lodge', 'modules', 'test', 'built')
+
+        c = Castor(self.root)
+        c.apply()
+
+        self.assertFalse(path.exists(built))
+
+        c.apply(exec_post_freeze=True)
+
+        self.assertTrue(path.exists(built))
+
+        unlink(built)
+        c.apply(exec_post_freeze=True)
+        c.apply()
+
+        self.assertFalse(path.exists(built))
+
+    def test_skipped_children(self):
+        self.patch_castorfile(lambda d: d['lodge'][0].update(version='v3'))
+
+        with self.assertRaises(CastorException) as cm:
+            Castor(self.root).apply()
+
+        lines = str(cm.exception).splitlines()
+
+        self.assertTrue(lines[1].startswith('  /: '))
+        self.assertIn('  /.htaccess: skipped: parent / failed', lines)
+        self.assertIn('  /modules/test: skipped: parent / failed', lines)
+        self.assertFalse(path.exists(path.join(self.root, 'lodge', 'modules', 'test')))
+
+
+class TestLock(ProjectTestCase):
+    def test_locked_apply(self):
+        c = Castor(self.root)
+
+        with self.assertRaises(CastorException):
+            c.apply(locked=True)
+
+        c.apply()
+        c.freeze()
+
+        with open(path.join(self.root, 'Castorfile.lock'), 'r') as f:
+            lock = json.load(f)
+
+        upstream = git.Repo(path.join(self.workdir, 'up1'))
+        self.assertEqual(lock['lodge']['/']['commit'], upstream.commit('v1').hexsha)
+        self.assertEqual(lock['lodge']['/']['tree'], upstream.commit('v1').tree.hexsha)
+
+        upstream.create_tag('v1', 'v2', force=True)
+        rmtree(path.join(self.root, 'lodge'))
+        c.apply(locked=True)
+
+        with open(path.join(self.root, 'lodge', 'test.txt'), 'r') as f:
+            self.assertEqual(f.read(), 'v1')
+
+        c.castorfile['lodge'][0]['version'] = 'v2'
+
+        with self.assertRaises(CastorException):
+            c.apply(locked=True)
+
+
+class TestFreezeTree(ProjectTestCase):
+    def test_same_as_files(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze(tree=True)
+
+        repo = git.Repo(self.root)
+        from_tree = repo.git.ls_files('-s', '--', 'dam')
+
+        self.assertFalse(path.exists(path.join(self.root, 'dam')))
+        self.assertEqual(len(from_tree.splitlines()), 3)
+
+        c.freeze()
+
+        self.assertEqual(repo.git.ls_files('-s', '--', 'dam'), from_tree)
+
+    def test_stale_dam(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        git.Repo(path.join(self.root, 'lodge')).git.checkout('v2')
+        c.freeze(tree=True)
+
+        repo = git.Repo(self.root)
+
+        self.assertFalse(path.exists(self.dam))
+
+        repo.git.add('-A')
+
+        self.assertEqual(repo.git.status('--porcelain', '--', 'dam'), '\n'.join([
+            'A  dam/.htaccess',
+            'A  dam/modules/test/test.txt',
+            'A  dam/test.txt',
+        ]))
+        self.assertEqual(repo.git.show(':dam/test.txt'), 'v2')
+
+        c.freeze()
+
+        self.assertEqual(list_files(self.dam)['test.txt'], 'v2')
+        self.assertEqual(repo.git.status('--porcelain', '--', 'dam'), '\n'.join([
+            'A  dam/.htaccess',
+            'A  dam/modules/test/test.txt',
+            'A  dam/test.txt',
+        ]))
+
+    def test_checkout(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze(tree=True, checkout=True)
+
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v1',
+            '.htaccess': 'Require all granted\n',
+            'modules/test/test.txt': 'v1',
+        })
+        self.assertEqual(git.Repo(self.root).git.status('--porcelain', '--', 'dam'), '\n'.join([
+            'A  dam/.htaccess',
+            'A  dam/modules/test/test.txt',
+            'A  dam/test.txt',
+        ]))
+
+
+class TestDirectoryFileTarget(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = path.join(self.root, 'config')
+        makedirs(path.join(self.config, 'sub'))
+
+        for name in ('a.php', 'sub/b.php', 'sub/c.txt'):
+            with open(path.join(self.config, name), 'w') as f:
+                f.write(name)
+
+        self.patch_castorfile(lambda d: d['lodge'].extend([
+            {'target': '/config', 'type': 'file', 'source': 'config'},
+            {'target': '/modules/test/php', 'type': 'file', 'source': 'config/**/*.php'},
+        ]))
+
+    def test_apply_and_freeze(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        expected = {
+            'test.txt': 'v1',
+            '.htaccess': 'Require all granted\n',
+            'config/a.php': 'a.php',
+            'config/sub/b.php': 'sub/b.php',
+            'config/sub/c.txt': 'sub/c.txt',
+            'modules/test/test.txt': 'v1',
+            'modules/test/php/a.php': 'a.php',
+            'modules/test/php/sub/b.php': 'sub/b.php',
+        }
+
+        self.assertEqual(list_files(self.dam), expected)
+
+        unlink(path.join(self.config, 'sub', 'b.php'))
+        del expected['config/sub/b.php']
+        del expected['modules/test/php/sub/b.php']
+
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        self.assertEqual(list_files(self.dam), expected)
+        self.assertFalse(path.exists(path.join(self.root, 'lodge', 'config', 'sub', 'b.php')))
+        self.assertFalse(path.exists(path.join(self.root, 'lodge', 'modules', 'test', 'php',
+                                               'sub')))
+
+        c.freeze(tree=True)
+        self.assertEqual(
+            sorted(git.Repo(self.root).git.ls_files('--', 'dam').splitlines()),
+            sorted('dam/' + x for x in expected)
+        )
+
+
+class TestFilters(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+
+        def add_filters(d):
+            d['exclude'] = ['*.md']
+            d['include'] = ['/README.md']
+            d['lodge'][0]['exclude'] = ['tests']
+            d['lodge'][2]['exclude'] = ['/test.txt']
+
+        self.patch_castorfile(add_filters)
+
+    def commit(self, files):
+        lodge = git.Repo(path.join(self.root, 'lodge'))
+
+        for name, content in files.items():
+            file_path = path.join(self.root, 'lodge', name)
+            makedirs(path.dirname(file_path), exist_ok=True)
+
+            with open(file_path, 'w') as f:
+                f.write(content)
+
+        lodge.index.add(list(files))
+        lodge.index.commit('Commit')
+
+    def test_filters(self):
+        c = Castor(self.root)
+        c.apply()
+        self.commit({
+            'README.md': 'readme',
+            'docs/a.md': 'doc',
+            'src/a.php': 'a',
+            'src/tests/t.php': 't',
+            'build/x.js': 'x',
+            '.gitattributes': 'build export-ignore\n',
+        })
+        c.freeze()
+
+        expected = {
+            '.gitattributes': 'build export-ignore\n',
+            '.htaccess': 'Require all granted\n',
+            'README.md': 'readme',
+            'src/a.php': 'a',
+            'test.txt': 'v1',
+        }
+        self.assertEqual(list_files(self.dam), expected)
+
+        self.commit({'src/b.php': 'b', 'src/tests/u.php': 'u', 'build/y.js': 'y', 'b.md': 'b'})
+        expected['src/b.php'] = 'b'
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        self.assertEqual(list_files(self.dam), expected)
+
+        Castor(self.root).freeze(tree=True)
+        self.assertEqual(
+            sorted(git.Repo(self.root).git.ls_files('--', 'dam').splitlines()),
+            sorted('dam/' + x for x in expected)
+        )
+
+    def test_export_ignore_dir(self):
+        c = Castor(self.root)
+        c.apply()
+        self.commit({
+            'src/a.php': 'a',
+            'vendor/lib/x.php': 'x',
+            'assets/img/y.png': 'y',
+            '.gitattributes': 'vendor/ export-ignore\nassets/** export-ignore\n',
+        })
+        c.freeze()
+
+        self.assertFalse(path.exists(path.join(self.dam, 'vendor')))
+        self.assertFalse(path.exists(path.join(self.dam, 'assets')))
+        self.assertEqual(list_files(path.join(self.dam, 'src')), {'a.php': 'a'})
+
+        self.commit({'src/b.php': 'b', 'vendor/lib/z.php': 'z'})
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        self.assertFalse(path.exists(path.join(self.dam, 'vendor')))
+        self.assertEqual(list_files(path.join(self.dam, 'src')), {'a.php': 'a', 'b.php': 'b'})
+
+
+class TestPostFreezeCache(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.counter = path.join(self.workdir, 'counter')
+
+        with open(self.counter, 'w') as f:
+            f.write('1')
+
+        self.patch_castorfile(lambda d: d['lodge'][2].update({
+            'post_freeze': ['cp {} built'.format(self.counter), 'rm test.txt'],
+            'post_freeze_inputs': ['htaccess'],
+        }))
+
+    def freeze(self, **kwargs):
+        rmtree(path.join(self.root, 'dam'), ignore_errors=True)
+        Castor(self.root).freeze(**kwargs)
+        return list_files(path.join(self.root, 'dam', 'modules', 'test'))
+
+    def test_restore(self):
+        Castor(self.root).apply()
+
+        self.assertEqual(self.freeze(), {'built': '1'})
+
+        with open(self.counter, 'w') as f:
+            f.write('2')
+
+        self.assertEqual(self.freeze(), {'built': '1'})
+        self.assertEqual(self.freeze(post_freeze_cache=False), {'built': '2'})
+
+        with open(path.join(self.root, 'htaccess'), 'w') as f:
+            f.write('Require all denied\n')
+
+        self.assertEqual(self.freeze(), {'built': '2'})
+
+    def test_file_target_removed(self):
+        with open(path.join(self.root, 'conf'), 'w') as f:
+            f.write('conf')
+
+        def add_conf(d):
+            d['lodge'][2]['post_freeze'].append('rm conf')
+            d['lodge'].append({'target': '/modules/test/conf', 'type': 'file', 'source': 'conf'})
+
+        self.patch_castorfile(add_conf)
+
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        with self.no_rebuild(c):
+            c.freeze()
+
+        self.assertEqual(list_files(path.join(self.dam, 'modules', 'test')), {'built': '1'})
+        self.assertEqual(git.Repo(self.root).git.status('--porcelain', '--', 'dam/modules'),
+                         'A  dam/modules/test/built')
+
+    def test_without_cache(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze(post_freeze_cache=False)
+
+        with open(self.counter, 'w') as f:
+            f.write('2')
+
+        c.freeze(post_freeze_cache=False)
+
+        self.assertEqual(list_files(path.join(self.dam, 'modules', 'test')), {'built': '2'})
+
+
+class TestExport(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch_castorfile(lambda d: d['lodge'][2].update({
+            'post_freeze': ['cp test.txt built', 'rm test.txt'],
+        }))
+
+    def test_export(self):
+        castor = Castor(self.root)
+        castor.apply()
+
+        first = path.join(self.workdir, 'first.tar.gz')
+        second = path.join(self.workdir, 'second.tar.gz')
+        castor.export(first)
+        castor.export(second)
+
+        with open(first, 'rb') as a, open(second, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+        with tarfile.open(first) as tar:
+            self.assertEqual([(x.name, x.mode, x.mtime) for x in tar.getmembers()], [
+                ('.htaccess', 0o664, 0),
+                ('modules', 0o775, 0),
+                ('modules/test', 0o775, 0),
+                ('modules/test/built', 0o664, 0),
+                ('test.txt', 0o664, 0),
+            ])
+
+        self.assertFalse(path.exists(path.join(self.root, 'dam')))
+
+        with self.assertRaises(CastorException):
+            castor.export(path.join(self.workdir, 'dam.zip'))
+
+
+class TestStatus(ProjectTestCase):
+    def summary(self, c):
+        return {x['target']: describe_status(x) for x in c.status()}
+
+    def test_status(self):
+        c = Castor(self.root)
+        c.apply()
+
+        self.assertEqual(self.summary(c), {'/': 'at v1', '/modules/test': 'at v1'})
+
+        c.freeze()
+        lodge = git.Repo(path.join(self.root, 'lodge'))
+        lodge.git.checkout('v2')
+
+        with open(path.join(self.root, 'lodge', 'test.txt'), 'w') as f:
+            f.write('changed')
+
+        rmtree(path.join(self.root, 'lodge', 'modules', 'test'))
+        statuses = c.status()
+
+        self.assertEqual(statuses[0]['head'], lodge.head.commit.hexsha)
+        self.assertEqual((statuses[0]['ahead'], statuses[0]['behind']), (1, 0))
+        self.assertEqual(self.summary(c), {
+            '/': 'at {}, 1 ahead and 0 behind v1, uncommitted changes'.format(
+                lodge.head.commit.hexsha[:10]
+            ),
+            '/modules/test': 'not cloned',
+        })
+
+    def test_submodule(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        sub = make_upstream(path.join(self.workdir, 'sub'), ['s1', 's2'])
+        lodge = git.Repo(path.join(self.root, 'lodge'))
+        lodge.git(c='protocol.file.allow=always').submodule('add', sub.working_dir, 'libs/sub')
+        lodge.index.commit('Added a submodule')
+
+        # Not in the Castorfile.lock, which is older than the submodule
+        self.assertEqual(self.summary(c)['/libs/sub'], 'at {}, on branch master'.format(
+            sub.commit('s2').hexsha[:10]
+        ))
+
+        git.Repo(path.join(lodge.working_dir, 'libs', 'sub')).git.checkout('s1')
+
+        self.assertEqual(self.summary(c)['/libs/sub'], 'at {}, 0 ahead and 1 behind {}'.format(
+            sub.commit('s1').hexsha[:10], sub.commit('s2').hexsha[:10]
+        ))
+
+
+class TestWatch(ProjectTestCase):
+    def test_refresh_watched(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        state = c.watch_state()
+        self.assertEqual(c.refresh_watched(state, c.watch_state()), [])
+
+        lodge = git.Repo(path.join(self.root, 'lodge', 'modules', 'test'))
+
+        with open(path.join(lodge.working_dir, 'added.txt'), 'w') as f:
+            f.write('added')
+
+        lodge.index.add(['added.txt'])
+        lodge.index.commit('Added a file')
+
+        with open(path.join(self.root, 'htaccess'), 'w') as f:
+            f.write('Require all denied\n')
+
+        with self.no_rebuild(c):
+            self.assertEqual(c.refresh_watched(state, c.watch_state()),
+                             ['/.htaccess', '/modules/test'])
+
+        self.assertEqual(c.castorfile['lodge'][2]['version'], lodge.head.commit.hexsha)
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v1',
+            '.htaccess': 'Require all denied\n',
+            'modules/test/test.txt': 'v1',
+            'modules/test/added.txt': 'added',
+        })
+
+    def test_keeps_polling(self):
+        c = Castor(self.root)
+        states = iter([{'/': 1}, {'/': 2}, {'/': 2}, {'/': 3}, {'/': 3}])
+        errors = [OSError('vanished'), KeyboardInterrupt()]
+        c.watch_state = lambda: next(states)
+
+        def refresh_watched(*args):
+            raise errors.pop(0)
+
+        c.refresh_watched = refresh_watched
+
+        with self.assertRaises(KeyboardInterrupt):
+            c.watch(interval=0, delay=0)
+
+        self.assertEqual(errors, [])
+
+    def test_castorfile_edited(self):
+        c = Castor(self.root)
+        c.apply()
+        c.freeze()
+
+        state = c.watch_state()
+        self.patch_castorfile(lambda d: d['lodge'][1].update(target='/.htaccess.dist'))
+        current = c.watch_state()
+
+        self.assertEqual(c.refresh_watched(state, current), ['Castorfile'])
+        self.assertEqual(Castor(self.root).castorfile['lodge'][1]['target'], '/.htaccess.dist')
+        self.assertEqual(list_files(self.dam), {
+            'test.txt': 'v1',
+            '.htaccess.dist': 'Require all granted\n',
+            'modules/test/test.txt': 'v1',
+        })
+
+        with open(path.join(self.root, 'Castorfile'), 'w') as f:
+            f.write('{')
+
+        with self.assertRaises(CastorException):
+            c.refresh_watched(current, c.watch_state())
+
+        with open(path.join(self.root, 'Castorfile'), 'r') as f:
+            self.assertEqual(f.read(), '{')
+
+
+class TestDeploy(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dest = path.join(self.workdir, 'www')
+
+    def test_deploy(self):
+        castor = Castor(self.root)
+
+        with self.assertRaises(CastorException):
+            castor.deploy(self.dest)
+
+        castor.apply()
+        castor.freeze()
+
+        self.assertEqual(castor.deploy(self.dest), (['.htaccess', 'modules/test/test.txt',
+                                                     'test.txt'], [], []))
+        self.assertEqual(list_files(self.dest), list_files(self.dam))
+        self.assertEqual(castor.deploy(self.dest), ([], [], []))
+
+        with open(path.join(self.root, 'htaccess'), 'w') as f:
+            f.write('Require all denied\n')
+
+        castor.castorfile['lodge'][2]['target'] = '/vendor/test'
+        castor.write_castorfile()
+        Castor(self.root).apply()
+        Castor(self.root).freeze()
+
+        self.assertEqual(Castor(self.root).deploy(self.dest), (
+            ['vendor/test/test.txt'], ['.htaccess'], ['modules/test/test.txt']
+        ))
+        self.assertEqual(list_files(self.dest), list_files(self.dam))
+        self.assertFalse(path.exists(path.join(self.dest, 'modules')))
+
+
 class TestEnsureLineInFile(unittest.TestCase):
     def test_ensure_when_empty(self):
         with NamedTemporaryFile('r') as f:
@@ -108,6 +1044,79 @@ class TestEnsureLineInFile(unittest.TestCase):
             self.assertEqual('hello\n', f.read())
 
 
+class TestRunCommand(unittest.TestCase):
+    def test_success(self):
+        run_command('true', '/', '[test]')
+
+    def test_exit_status(self):
+        with self.assertRaises(CastorException):
+            run_command('false', '/', '[test]')
+
+    def test_timeout(self):
+        with self.assertRaises(CastorException):
+            run_command('sleep 10', '/', '[test]', timeout=0.2)
+
+
+class TestPostFreezeFailure(ProjectTestCase):
+    def test_post_freeze_failure(self):
+        self.patch_castorfile(lambda d: d['lodge'][2].update({
+            'post_freeze': ['touch foo', 'false'],
+        }))
+
+        c = Castor(self.root)
+        c.apply()
+
+        with self.assertRaises(CastorException):
+            c.freeze(jobs=2)
+
+        self.assertTrue(path.exists(path.join(self.dam, 'modules', 'test', 'foo')))
+
+
+class TestWriteManagedLines(unittest.TestCase):
+    def setUp(self):
+        self.workdir = mkdtemp()
+        self.file_path = path.join(self.workdir, 'info', 'exclude')
+
+    def tearDown(self):
+        rmtree(self.workdir)
+
+    def read(self):
+        with open(self.file_path, 'r') as f:
+            return f.read()
+
+    def test_replace_block(self):
+        write_managed_lines(self.file_path, ['/a', '/b'])
+        self.assertEqual(self.read(), '# BEGIN Castor\n/a\n/b\n# END Castor\n')
+
+        write_managed_lines(self.file_path, ['/b'])
+        self.assertEqual(self.read(), '# BEGIN Castor\n/b\n# END Castor\n')
+
+        write_managed_lines(self.file_path, [])
+        self.assertEqual(self.read(), '')
+
+    def test_keep_other_lines(self):
+        makedirs(path.dirname(self.file_path))
+
+        with open(self.file_path, 'w') as f:
+            f.write('# comment\n*.log\n/a')
+
+        write_managed_lines(self.file_path, ['/a'])
+        self.assertEqual(self.read(), '# comment\n*.log\n# BEGIN Castor\n/a\n# END Castor\n')
+
+    def test_ignore_targets(self):
+        repos = [path.join(self.workdir, 'l', ''), path.join(self.workdir, 'l', 'm', 'test')]
+        files = [path.join(self.workdir, 'l', '.htaccess'),
+                 path.join(self.workdir, 'l', 'm', 'test', 'conf')]
+
+        Castor.ignore_targets(repos, files)
+
+        with open(path.join(repos[0], '.git', 'info', 'exclude')) as f:
+            self.assertEqual(f.read(), '# BEGIN Castor\n/.htaccess\n/m/test\n# END Castor\n')
+
+        with open(path.join(repos[1], '.git', 'info', 'exclude')) as f:
+            self.assertEqual(f.read(), '# BEGIN Castor\n/conf\n# END Castor\n')
+
+
 class TestCastor(unittest.TestCase):
     def setUp(self):
         self.real_root = path.join(ASSETS_ROOT, 'test1')
@@ -0,0 +1,48 @@
+# vim: fileencoding=utf-8 tw=100 expandtab ts=4 sw=4 :
+#
+# Castor
+# (c) 2015 ActivKonnect
+# Rémy Sanchez <remy.sanchez@activkonnect.com>
+
+import unittest
+import subprocess
+
+from castor.timing import Tracer, NULL_SPAN, command_name
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tracer = Tracer()
+
+    def tearDown(self):
+        self.tracer.disable()
+
+    def test_disabled(self):
+        init = subprocess.Popen.__init__
+
+        self.assertIs(self.tracer.span('apply', '/'), NULL_SPAN)
+        self.assertIs(subprocess.Popen.__init__, init)
+        self.assertEqual(self.tracer.trace()['traceEvents'], [])
+
+    def test_spans(self):
+        init = subprocess.Popen.__init__
+        self.tracer.enable()
+
+        with self.tracer.span('apply_target', '/modules/test'):
+            with self.tracer.span('checkout', version='v1'):
+                subprocess.check_call(['git', 'version'], stdout=subprocess.DEVNULL)
+
+        self.tracer.disable()
+        self.assertIs(subprocess.Popen.__init__, init)
+
+        events = {x['name']: x for x in self.tracer.trace()['traceEvents']}
+
+        self.assertEqual(set(events), {'apply_target', 'checkout', 'git version'})
+        self.assertEqual(events['checkout']['args'], {'version': 'v1', 'target': '/modules/test'})
+        self.assertEqual(events['git version']['cat'], 'subprocess')
+        self.assertEqual(events['git version']['args']['target'], '/modules/test')
+        self.assertIn('/modules/test', self.tracer.summary())
+
+    def test_command_name(self):
+        self.assertEqual(command_name(['git', '-C', 'x', 'fetch', 'origin'])[0], 'git fetch')
+        self.assertEqual(command_name('/usr/bin/composer install')[0], 'composer')